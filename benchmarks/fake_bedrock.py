@@ -0,0 +1,191 @@
+"""Stand-ins for the `bedrock-runtime` client: a deterministic scripted agent, replay of recorded responses and a
+recorder that captures the responses of the real client."""
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+# SQL the scripted data engineer runs for questions containing the keyword, checked in order
+SCRIPTED_QUERIES = [
+    ('benchmark', "SELECT Name, Score FROM Benchmarks ORDER BY Score"),
+    ('score', """
+        SELECT C.Name, AVG(SSR.Score) AS average_score
+        FROM StudentScoreResults AS SSR
+        JOIN Students AS S ON S.Student_ID = SSR.Student_ID
+        JOIN Countries AS C ON C.Country_ID = S.Country_ID
+        WHERE SSR.Code = 'ASRREA_avg'
+        GROUP BY C.Name
+        ORDER BY average_score DESC
+    """),
+    ('school', """
+        SELECT C.Name, COUNT(*) AS schools
+        FROM Schools AS Sch
+        JOIN Countries AS C ON C.Country_ID = Sch.Country_ID
+        GROUP BY C.Name
+    """),
+    ('', """
+        SELECT C.Name, COUNT(*) AS students
+        FROM Students AS S
+        JOIN Countries AS C ON C.Country_ID = S.Country_ID
+        GROUP BY C.Name
+    """),
+]
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def request_digest(body: str) -> str:
+    return hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+
+
+def request_text(request: dict) -> tuple[str, str]:
+    """(system prompt, text of all messages) of an anthropic messages request."""
+    parts = []
+    for message in request.get('messages', []):
+        content = message['content']
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get('text', '') for block in content if isinstance(block, dict))
+    return request.get('system', ''), '\n'.join(parts)
+
+
+def scripted_response(request: dict) -> str:
+    """Answers like a ReAct agent of the crews: delegates to the data engineer if it can, queries the database if it
+    can, and gives the final answer once it has seen an observation."""
+    system, text = request_text(request)
+    prompt = f'{system}\n{text}'
+    if 'Observation:' in text:
+        observation = text.rsplit('Observation:', 1)[1].strip()
+        return f'Thought: I now know the final answer\nFinal Answer: {observation[:500]}'
+    if 'Delegate work to coworker' in prompt:
+        action_input = {
+            'task': 'Query the PIRLS database for the data needed to answer the question.',
+            'context': text[-500:],
+            'coworker': 'data engineer'
+        }
+        return f'Thought: I need data\nAction: Delegate work to coworker\nAction Input: {json.dumps(action_input)}'
+    if 'query_database' in prompt:
+        lowered = text.lower()
+        query = next(query for keyword, query in SCRIPTED_QUERIES if keyword in lowered)
+        query = re.sub(r'\s+', ' ', query).strip()
+        return f'Thought: I should query the database\nAction: query_database\nAction Input: {json.dumps({"query": query})}'
+    return 'Thought: I now know the final answer\nFinal Answer: I could not find the data.'
+
+
+class FakeBedrockClient:
+    """Answers `invoke_model` and `invoke_model_with_response_stream` in the anthropic messages format, including the
+    token count headers and invocation metrics Bedrock returns.
+
+    Responses are replayed from `recordings` (request digest -> completion, see `RecordingBedrockClient`) and
+    generated by `scripted_response` otherwise. Every response is delayed by `latency` seconds plus
+    `latency_per_token` per completion token, with +-`jitter` relative noise from a seeded generator.
+    """
+
+    def __init__(
+            self,
+            recordings: Optional[Path] = None,
+            latency: float = 0.5,
+            latency_per_token: float = 0.005,
+            jitter: float = 0.1,
+            seed: int = 0
+    ):
+        self.recordings: dict[str, str] = {}
+        if recordings is not None and recordings.exists():
+            for line in recordings.read_text().splitlines():
+                record = json.loads(line)
+                self.recordings[record['digest']] = record['completion']
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.jitter = jitter
+        self.requests = 0
+        self.replayed = 0
+        self.llm_time = 0.0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def __complete(self, body: str) -> tuple[str, int, int]:
+        start = time.perf_counter()
+        request = json.loads(body)
+        completion = self.recordings.get(request_digest(body))
+        replayed = completion is not None
+        if completion is None:
+            completion = scripted_response(request)
+        # honour the stop sequences like the model does, e.g. crewai stops at '\nObservation'
+        for stop in request.get('stop_sequences', []):
+            completion = completion.split(stop, 1)[0]
+        system, text = request_text(request)
+        prompt_tokens, completion_tokens = estimate_tokens(system + text), estimate_tokens(completion)
+        with self.__lock:
+            noise = 1 + self.__random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, (self.latency + self.latency_per_token * completion_tokens) * noise))
+        with self.__lock:
+            self.requests += 1
+            self.replayed += replayed
+            self.llm_time += time.perf_counter() - start
+        return completion, prompt_tokens, completion_tokens
+
+    def invoke_model(self, body: str, **kwargs) -> dict:
+        completion, prompt_tokens, completion_tokens = self.__complete(body)
+        response = {
+            'id': 'msg_fake',
+            'type': 'message',
+            'role': 'assistant',
+            'content': [{'type': 'text', 'text': completion}],
+            'stop_reason': 'end_turn',
+            'usage': {'input_tokens': prompt_tokens, 'output_tokens': completion_tokens}
+        }
+        return {
+            'body': io.BytesIO(json.dumps(response).encode()),
+            'ResponseMetadata': {'HTTPHeaders': {
+                'x-amzn-bedrock-input-token-count': str(prompt_tokens),
+                'x-amzn-bedrock-output-token-count': str(completion_tokens)
+            }}
+        }
+
+    def invoke_model_with_response_stream(self, body: str, **kwargs) -> dict:
+        completion, prompt_tokens, completion_tokens = self.__complete(body)
+        events = [
+            {'type': 'message_start', 'message': {'usage': {'input_tokens': prompt_tokens}}},
+            {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': completion}},
+            {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}},
+            {'type': 'message_stop', 'amazon-bedrock-invocationMetrics': {
+                'inputTokenCount': prompt_tokens, 'outputTokenCount': completion_tokens
+            }}
+        ]
+        return {'body': ({'chunk': {'bytes': json.dumps(event).encode()}} for event in events)}
+
+    def stats(self) -> dict[str, int | float]:
+        with self.__lock:
+            return {'requests': self.requests, 'replayed': self.replayed, 'llm_time': self.llm_time}
+
+
+class RecordingBedrockClient:
+    """Passes requests to the real `client` and appends (request digest, completion) records to `path`, for replay by
+    `FakeBedrockClient`. Only `invoke_model` is recorded."""
+
+    def __init__(self, client, path: Path):
+        self.client = client
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def invoke_model(self, body: str, **kwargs) -> dict:
+        response = self.client.invoke_model(body=body, **kwargs)
+        raw = response['body'].read()
+        completion = ''.join(block.get('text', '') for block in json.loads(raw).get('content', []))
+        with self.__lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open('a') as file:
+                file.write(json.dumps({'digest': request_digest(body), 'completion': completion}) + '\n')
+        response['body'] = io.BytesIO(raw)
+        return response
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
@@ -0,0 +1,115 @@
+"""Local SQLite stand-in for the PIRLS database, with the schema the agents are told about and synthetic data."""
+import random
+import sqlite3
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE Countries (Country_ID INTEGER PRIMARY KEY, Name TEXT, Code TEXT, Benchmark BOOLEAN, TestType TEXT);
+CREATE TABLE Schools (School_ID INTEGER PRIMARY KEY, Country_ID INTEGER);
+CREATE TABLE Homes (Home_ID INTEGER PRIMARY KEY);
+CREATE TABLE Students (Student_ID INTEGER PRIMARY KEY, Country_ID INTEGER, School_ID INTEGER, Home_ID INTEGER);
+CREATE TABLE Teachers (Teacher_ID INTEGER PRIMARY KEY, School_ID INTEGER);
+CREATE TABLE StudentTeachers (Teacher_ID INTEGER, Student_ID INTEGER);
+CREATE TABLE Curricula (Curriculum_ID INTEGER PRIMARY KEY, Country_ID INTEGER);
+CREATE TABLE StudentScoreEntries (Code TEXT PRIMARY KEY, Name TEXT, Type TEXT);
+CREATE TABLE StudentScoreResults (Student_ID INTEGER, Code TEXT, Score REAL);
+CREATE TABLE Benchmarks (Benchmark_ID INTEGER PRIMARY KEY, Score INTEGER, Name TEXT);
+"""
+
+# general table -> (entries table, answers table, id column)
+QUESTIONNAIRES = {
+    'Students': ('StudentQuestionnaireEntries', 'StudentQuestionnaireAnswers', 'Student_ID'),
+    'Schools': ('SchoolQuestionnaireEntries', 'SchoolQuestionnaireAnswers', 'School_ID'),
+    'Teachers': ('TeacherQuestionnaireEntries', 'TeacherQuestionnaireAnswers', 'Teacher_ID'),
+    'Homes': ('HomeQuestionnaireEntries', 'HomeQuestionnaireAnswers', 'Home_ID'),
+    'Curricula': ('CurriculumQuestionnaireEntries', 'CurriculumQuestionnaireAnswers', 'Curriculum_ID'),
+}
+
+COUNTRIES = [
+    ('Germany', 'DEU'), ('Austria', 'AUT'), ('France', 'FRA'), ('Poland', 'POL'), ('Italy', 'ITA'),
+    ('Spain', 'ESP'), ('Sweden', 'SWE'), ('Finland', 'FIN'), ('Ireland', 'IRL'), ('Portugal', 'PRT'),
+    ('Norway', 'NOR'), ('Denmark', 'DNK'), ('Czech Republic', 'CZE'), ('Hungary', 'HUN'), ('Slovenia', 'SVN')
+]
+SCORE_CODES = ['ASRREA', 'ASRLIT', 'ASRINF', 'ASRIIE', 'ASRRSI']
+BENCHMARKS = [
+    (1, 400, 'Low International Benchmark'), (2, 475, 'Intermediate International Benchmark'),
+    (3, 550, 'High International Benchmark'), (4, 625, 'Advanced International Benchmark')
+]
+ANSWERS = ['Yes', 'No', 'Sometimes', 'Omitted or invalid', 'nan']
+QUESTIONS_PER_TYPE = 5
+QUESTION_TYPES = ['Home Resources', 'Reading Habits', 'School Climate']
+
+
+def build_fixture(
+        path: Path,
+        countries: int = 10,
+        schools_per_country: int = 10,
+        students_per_school: int = 20,
+        seed: int = 0
+) -> Path:
+    """Writes a PIRLS-shaped SQLite database to `path` (replacing it) and returns the path. The data is random but
+    fully determined by the arguments."""
+    rng = random.Random(seed)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    for entries_table, answers_table, id_column in QUESTIONNAIRES.values():
+        connection.execute(f'CREATE TABLE {entries_table} (Code TEXT PRIMARY KEY, Question TEXT, Type TEXT)')
+        connection.execute(f'CREATE TABLE {answers_table} ({id_column} INTEGER, Code TEXT, Answer TEXT)')
+        connection.execute(f'CREATE INDEX {answers_table}_code ON {answers_table} (Code, {id_column})')
+    connection.execute('CREATE INDEX StudentScoreResults_code ON StudentScoreResults (Code, Student_ID)')
+
+    connection.executemany('INSERT INTO Countries VALUES (?, ?, ?, ?, ?)', [
+        (country_id, name, code, country_id % 5 == 0, 'digital' if country_id % 2 else 'paper')
+        for country_id, (name, code) in enumerate(COUNTRIES[:countries], start=1)
+    ])
+    connection.executemany('INSERT INTO Benchmarks VALUES (?, ?, ?)', BENCHMARKS)
+    connection.executemany('INSERT INTO StudentScoreEntries VALUES (?, ?, ?)', [
+        (f'{code}_{stat}', f'{code} {stat}', 'score') for code in SCORE_CODES for stat in ('avg', 'std')
+    ])
+    connection.executemany('INSERT INTO Curricula VALUES (?, ?)', [(i, i) for i in range(1, countries + 1)])
+
+    schools, students, teachers, student_teachers, scores = [], [], [], [], []
+    for country_id in range(1, countries + 1):
+        country_mean = rng.gauss(520, 30)
+        for _ in range(schools_per_country):
+            school_id = len(schools) + 1
+            schools.append((school_id, country_id))
+            teacher_id = len(teachers) + 1
+            teachers.append((teacher_id, school_id))
+            for _ in range(students_per_school):
+                student_id = len(students) + 1
+                students.append((student_id, country_id, school_id, student_id))
+                student_teachers.append((teacher_id, student_id))
+                for code in SCORE_CODES:
+                    scores.append((student_id, f'{code}_avg', rng.gauss(country_mean, 70)))
+                    scores.append((student_id, f'{code}_std', abs(rng.gauss(30, 5))))
+    connection.executemany('INSERT INTO Schools VALUES (?, ?)', schools)
+    connection.executemany('INSERT INTO Homes VALUES (?)', [(student[0],) for student in students])
+    connection.executemany('INSERT INTO Students VALUES (?, ?, ?, ?)', students)
+    connection.executemany('INSERT INTO Teachers VALUES (?, ?)', teachers)
+    connection.executemany('INSERT INTO StudentTeachers VALUES (?, ?)', student_teachers)
+    connection.executemany('INSERT INTO StudentScoreResults VALUES (?, ?, ?)', scores)
+
+    entity_ids = {
+        'Students': [student[0] for student in students],
+        'Schools': [school[0] for school in schools],
+        'Teachers': [teacher[0] for teacher in teachers],
+        'Homes': [student[0] for student in students],
+        'Curricula': list(range(1, countries + 1)),
+    }
+    for general_table, (entries_table, answers_table, _) in QUESTIONNAIRES.items():
+        prefix = general_table[:2].upper()
+        codes = []
+        for type_index, question_type in enumerate(QUESTION_TYPES):
+            for question_index in range(QUESTIONS_PER_TYPE):
+                code = f'A{prefix}G{type_index}{question_index}'
+                codes.append((code, f'{question_type} question {question_index}?', question_type))
+        connection.executemany(f'INSERT INTO {entries_table} VALUES (?, ?, ?)', codes)
+        connection.executemany(f'INSERT INTO {answers_table} VALUES (?, ?, ?)', [
+            (entity_id, code, rng.choice(ANSWERS)) for entity_id in entity_ids[general_table] for code, _, _ in codes
+        ])
+    connection.commit()
+    connection.close()
+    return path
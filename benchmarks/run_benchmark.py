@@ -0,0 +1,187 @@
+"""Offline end-to-end benchmark of `/run`.
+
+    python -m benchmarks.run_benchmark --crew basic advanced --concurrency 1 4 8 --requests 40
+
+Runs the service in-process against `FakeBedrockClient` (scripted or replayed responses with simulated latency) and a
+SQLite fixture of the PIRLS schema, and reports per crew and concurrency: p50/p95/p99 latency, requests per second,
+database vs LLM time per request and tokens per question. No AWS or Postgres access is needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from benchmarks.fake_bedrock import FakeBedrockClient
+from benchmarks.pirls_fixture import build_fixture
+
+QUESTIONS = [
+    'How many students from each country participated in PIRLS?',
+    'What is the average reading score of students in each country?',
+    'How many schools took part in each country?',
+    'What are the score thresholds of the international benchmarks?',
+    'Which country has the highest average reading score?',
+]
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+class DatabaseTimer:
+    """Sums the execution time of the statements run through `engine`."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.statements = 0
+        self.db_time = 0.0
+        self.__lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.__before)
+        event.listen(engine, 'after_cursor_execute', self.__after)
+
+    def __before(self, connection, cursor, statement, parameters, context, executemany):
+        context._benchmark_start = time.perf_counter()
+
+    def __after(self, connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._benchmark_start
+        with self.__lock:
+            self.statements += 1
+            self.db_time += elapsed
+
+    def stats(self) -> dict[str, int | float]:
+        with self.__lock:
+            return {'statements': self.statements, 'db_time': self.db_time}
+
+
+async def run_level(client, questions: list[str], requests: int, concurrency: int, timeout: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, tokens, failures = [], [], 0
+
+    async def one(index: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post('/run', json={
+                'prompt': questions[index % len(questions)], 'timeout': timeout
+            }, timeout=None)
+            latencies.append(time.perf_counter() - start)
+            body = response.json()
+            if response.status_code != 200 or body.get('timed_out') or body.get('result') is None:
+                failures += 1
+            else:
+                tokens.append(body['tokens'])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    wall_time = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'failures': failures,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'rps': requests / wall_time,
+        'tokens_per_question': sum(tokens) / len(tokens) if tokens else 0.0
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> list[dict]:
+    # configure the service before it is imported
+    fixture = build_fixture(args.fixture, countries=args.countries, students_per_school=args.students_per_school)
+    os.environ['DB_URL'] = f'sqlite:///{fixture}'
+    os.environ['QUESTIONNAIRE_INDEX_PATH'] = str(fixture.with_suffix('.index.json'))
+    os.environ['RUN_MAX_CONCURRENCY'] = str(max(args.concurrency))
+    os.environ['RUN_MAX_QUEUE_DEPTH'] = str(args.requests)
+    # every request has to run the crew, repeated questions must not be answered from the cache
+    os.environ['ANSWER_CACHE_SIZE'] = '0'
+    if args.no_query_cache:
+        os.environ['QUERY_CACHE_SIZE'] = '0'
+
+    import httpx
+    from src.static import app as service
+    from src.static.ChatBedrockWrapper import set_bedrock_client
+    from src.static.submission_pool import SubmissionPool
+    from src.static.util import get_engine
+    from src.submission import create_submission
+    from src.submission.crews.advanced_PIRLS_crew import AdvancedPIRLSCrew
+    from src.submission.crews.basic_PIRLS_crew import BasicPIRLSCrew
+
+    bedrock = FakeBedrockClient(
+        recordings=args.recordings, latency=args.latency, latency_per_token=args.latency_per_token, seed=args.seed
+    )
+    set_bedrock_client(bedrock)
+    database = DatabaseTimer(get_engine())
+    crews = {'basic': BasicPIRLSCrew, 'advanced': AdvancedPIRLSCrew}
+
+    results = []
+    async with service.lifespan(service.app):
+        await asyncio.to_thread(service.READY.wait)
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            for crew in args.crew:
+                create_submission.SUBMISSION_POOL = SubmissionPool(
+                    lambda crew_class=crews[crew]: create_submission.build_crew(crew_class)
+                )
+                create_submission.SUBMISSION_POOL.warm_up(max(args.concurrency))
+                for concurrency in args.concurrency:
+                    llm_before, db_before = bedrock.stats(), database.stats()
+                    result = await run_level(client, QUESTIONS, args.requests, concurrency, args.timeout)
+                    llm_after, db_after = bedrock.stats(), database.stats()
+                    result['crew'] = crew
+                    result['llm_time_per_request'] = (llm_after['llm_time'] - llm_before['llm_time']) / args.requests
+                    result['llm_calls_per_request'] = (llm_after['requests'] - llm_before['requests']) / args.requests
+                    result['db_time_per_request'] = (db_after['db_time'] - db_before['db_time']) / args.requests
+                    result['statements_per_request'] = (db_after['statements'] - db_before['statements']) / args.requests
+                    results.append(result)
+    return results
+
+
+def print_results(results: list[dict]) -> None:
+    header = (
+        f'{"crew":<9}{"conc":>5}{"reqs":>6}{"fail":>5}{"p50 s":>8}{"p95 s":>8}{"p99 s":>8}{"req/s":>8}'
+        f'{"llm s/req":>10}{"db s/req":>10}{"tokens/q":>10}'
+    )
+    print(header)
+    for r in results:
+        print(
+            f'{r["crew"]:<9}{r["concurrency"]:>5}{r["requests"]:>6}{r["failures"]:>5}{r["p50"]:>8.2f}{r["p95"]:>8.2f}'
+            f'{r["p99"]:>8.2f}{r["rps"]:>8.2f}{r["llm_time_per_request"]:>10.2f}{r["db_time_per_request"]:>10.3f}'
+            f'{r["tokens_per_question"]:>10.0f}'
+        )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--crew', nargs='+', choices=['basic', 'advanced'], default=['basic', 'advanced'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 8])
+    parser.add_argument('--requests', type=int, default=20, help='requests per crew and concurrency level')
+    parser.add_argument('--timeout', type=int, default=300, help='Payload.timeout of every request')
+    parser.add_argument('--latency', type=float, default=0.5, help='simulated seconds per Bedrock request')
+    parser.add_argument('--latency-per-token', type=float, default=0.005, help='simulated seconds per output token')
+    parser.add_argument('--recordings', type=Path, default=None, help='JSONL of recorded Bedrock completions')
+    parser.add_argument('--countries', type=int, default=10)
+    parser.add_argument('--students-per-school', type=int, default=20)
+    parser.add_argument('--fixture', type=Path, default=Path(tempfile.gettempdir()) / 'pirls_benchmark.sqlite')
+    parser.add_argument('--no-query-cache', action='store_true', help='disable the query result cache')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=Path, default=None, help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run_benchmark(args))
+    print_results(results)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,94 @@
-import logging
-from collections import defaultdict
-from typing import Dict, Any, Optional, List, Tuple, Iterator, AsyncIterator, Union
+import hashlib
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, List, Literal, Tuple, Iterator, AsyncIterator, Union
 
 from langchain_aws import ChatBedrock
 from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
 from langchain_core.language_models import LanguageModelInput
+from langchain_core.language_models.chat_models import generate_from_stream
 from langchain_core.messages import ToolCall, AIMessageChunk, BaseMessage
-from langchain_core.outputs import GenerationChunk
+from langchain_core.outputs import ChatResult, GenerationChunk
 from langchain_core.pydantic_v1 import Field
 from langchain_core.runnables import RunnableConfig
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-TOKEN_COUNTER: dict[str, dict[str, dict[str, int]]] = defaultdict(lambda: {})
-
-
-def get_total_number_of_tokens(call_id: str) -> int:
-    return sum(map(lambda d: d['total_tokens'], TOKEN_COUNTER[call_id].values()))
-
-
-def get_total_cost(call_id: str) -> float:
-    return sum(map(lambda d: d['total_cost'], TOKEN_COUNTER[call_id].values()))
-
-
-def get_token_details(call_id: str) -> dict:
-    return {
-        model_id: {
-            'prompt_tokens': values['prompt_tokens'],
-            'completion_tokens': values['completion_tokens']
-        }
-        for model_id, values in TOKEN_COUNTER[call_id].items()
-    }
-
-
-def _empty_metrics() -> dict[str, int | float]:
-    return {
-        'total_tokens': 0,
-        'prompt_tokens': 0,
-        'completion_tokens': 0,
-        'successful_requests': 0,
-        'total_cost': 0
-    }
+from src.static.bedrock_limiter import deduplicated_call, get_limiter, request_key
+from src.static.call_context import check_cancelled
+from src.static.metrics import LLM_IN_FLIGHT, LLM_LATENCY, LLM_TIME_TO_FIRST_TOKEN
+from src.static.query_cache import QueryCache
+from src.static.run_events import AnswerTokens, has_listener
+from src.static.tracing import span, start_span, end_span
+# the accounting lives in its own module so the service can import it without langchain, re-exported here
+from src.static.token_accounting import (
+    COST_MAPPING, ModelUsage, UsageReconciliation, CallAccounting, TOKEN_COUNTER, get_total_number_of_tokens,
+    get_total_cost, get_token_details, get_token_reconciliation, get_token_cost, compute_llm_call_cost
+)
+
+# (model_id, content hash) -> number of tokens
+TOKEN_COUNT_CACHE = QueryCache(max_size=int(os.environ.get('TOKEN_COUNT_CACHE_SIZE', 8192)), ttl=None)
+
+_BEDROCK_CLIENT = None
+_BEDROCK_CLIENT_LOCK = threading.Lock()
+
+
+def get_bedrock_client():
+    """The `bedrock-runtime` client shared by all wrappers. boto3 clients are thread-safe, so there is no need to pay
+    for a new session and client (and their connection pool) per request. Created like `ChatBedrock` would."""
+    global _BEDROCK_CLIENT
+    with _BEDROCK_CLIENT_LOCK:
+        if _BEDROCK_CLIENT is None:
+            import boto3
+            from botocore.config import Config
+
+            session = boto3.Session(profile_name=os.environ.get('AWS_PROFILE'))
+            _BEDROCK_CLIENT = session.client(
+                'bedrock-runtime',
+                region_name=os.environ.get('AWS_DEFAULT_REGION', session.region_name),
+                # every concurrent run may have a request in flight. Throttled requests are retried by the wrapper
+                # (see bedrock_limiter.py), with the rate limits and the backoff shared by all calls
+                config=Config(
+                    max_pool_connections=int(os.environ.get('BEDROCK_MAX_POOL_CONNECTIONS', 32)),
+                    retries={'mode': 'standard', 'total_max_attempts': 1}
+                )
+            )
+        return _BEDROCK_CLIENT
+
+
+def set_bedrock_client(client) -> None:
+    """Replaces the shared client, e.g. with a stub in benchmarks."""
+    global _BEDROCK_CLIENT
+    with _BEDROCK_CLIENT_LOCK:
+        _BEDROCK_CLIENT = client
+
+
+# Set by `ChatBedrockWrapper.invoke` so that the lower-level hooks it ends in can mark the request as accounted for
+_INVOKE_ACCOUNTED: ContextVar[Optional[list[bool]]] = ContextVar('_INVOKE_ACCOUNTED', default=None)
+
+
+def _reported_usage(usage: Optional[dict]) -> Optional[tuple[int, int]]:
+    """(prompt tokens, completion tokens) from Bedrock's `usage` (llm output) or `usage_metadata` (stream chunk,
+    message) dicts, or None if nothing was reported."""
+    if not usage:
+        return None
+    prompt_tokens = usage.get('prompt_tokens', usage.get('input_tokens', 0))
+    completion_tokens = usage.get('completion_tokens', usage.get('output_tokens', 0))
+    if not prompt_tokens and not completion_tokens:
+        return None
+    return prompt_tokens, completion_tokens
 
 
 class ChatBedrockWrapper(ChatBedrock):
     call_id: str = Field(exclude=False)
     model_name: str = Field(exclude=False, default='AWS_Bedrock')
     model_id: str = Field(exclude=False)
-
+    # 'reported': bill the usage Bedrock returns, count locally only when it is missing
+    # 'estimated': always count locally
+    # 'reconcile': like 'reported', but also count locally and keep a report of both (`get_token_reconciliation`)
+    token_usage_mode: Literal['reported', 'estimated', 'reconcile'] = Field(
+        exclude=False, default_factory=lambda: os.environ.get('TOKEN_USAGE_MODE', 'reported')
+    )
 
     def invoke(
             self,
@@ -58,14 +98,40 @@ class ChatBedrockWrapper(ChatBedrock):
             stop: Optional[List[str]] = None,
             **kwargs: Any,
     ) -> BaseMessage:
-        messages = map(lambda m: m.content, self._convert_input(input).to_messages())
-        messages = [{'content': message} for message in messages]
-        self._update_token_counter_prompt(None, None, messages)
-        ret = super().invoke(input, config, stop=stop, **kwargs)
-        content = ret.content if isinstance(ret.content, str) else ''
-        self._update_token_counter_completion(content)
+        # the request normally ends up in one of the hooks below, which account for it; only otherwise (e.g. the
+        # converse API) the returned message is accounted for here
+        accounted = [False]
+        token = _INVOKE_ACCOUNTED.set(accounted)
+        try:
+            ret = super().invoke(input, config, stop=stop, **kwargs)
+        finally:
+            _INVOKE_ACCOUNTED.reset(token)
+        if not accounted[0]:
+            messages = map(lambda m: m.content, self._convert_input(input).to_messages())
+            messages = [{'content': message} for message in messages]
+            content = ret.content if isinstance(ret.content, str) else ''
+            self._record_usage(None, None, messages, content, _reported_usage(getattr(ret, 'usage_metadata', None)))
         return ret
 
+    def _generate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        # the completions of a call someone listens to (see `/run/stream`) are streamed, so their tokens are published
+        # as they arrive
+        if (
+                not self.streaming and not self.beta_use_converse_api and self._get_provider() == 'anthropic'
+                and has_listener(self.call_id)
+        ):
+            # passed like the non-streaming path does, `stop` would be written into the shared `model_kwargs`
+            if stop:
+                kwargs['stop_sequences'] = stop
+            return generate_from_stream(self._stream(messages, None, run_manager, **kwargs))
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
     def _prepare_input_and_invoke(
             self,
             prompt: Optional[str] = None,
@@ -75,16 +141,96 @@ class ChatBedrockWrapper(ChatBedrock):
             run_manager: Optional[CallbackManagerForLLMRun] = None,
             **kwargs: Any,
     ) -> Tuple[str, List[ToolCall], Dict[str, Any]]:
-        self._update_token_counter_prompt(prompt, system, messages)
-        text, tool_calls, metadata = super()._prepare_input_and_invoke(prompt, system, messages, stop, run_manager, **kwargs)
-        self._update_token_counter_completion(text)
+        check_cancelled(self.call_id)
+        limiter = get_limiter(self.model_id)
+        estimate = self.__estimate_tokens(prompt, system, messages)
+        # identical deterministic requests of concurrent calls are sent once
+        key = request_key(
+            self.model_id, {**(self.model_kwargs or {}), **kwargs}, prompt=prompt, system=system, messages=messages,
+            stop=stop
+        )
+        invoke = super()._prepare_input_and_invoke
+
+        with span('bedrock.invoke', 'llm', self.call_id, **{'llm.model_id': self.model_id}) as current:
+            def request() -> Tuple[str, List[ToolCall], Dict[str, Any]]:
+                start = time.perf_counter()
+                with LLM_IN_FLIGHT.track(model_id=self.model_id):
+                    ret = invoke(prompt, system, messages, stop, run_manager, **kwargs)
+                # without streaming the first token arrives with the whole completion
+                self.__first_token(current, start)
+                LLM_LATENCY.observe(time.perf_counter() - start, model_id=self.model_id)
+                return ret
+
+            (text, tool_calls, metadata), source = deduplicated_call(
+                limiter, self.call_id, key, lambda: limiter.call(self.call_id, estimate, request)
+            )
+            current.set(**{'llm.source': source})
+            if source != 'bedrock':
+                # billed to the call whose request it was
+                self.__mark_accounted()
+                return text, tool_calls, metadata
+            usage = self._record_usage(prompt, system, messages, text, _reported_usage(metadata.get('usage')))
+            limiter.settle(estimate, sum(usage) if usage is not None else estimate)
+            current.set(**self.__span_usage(usage))
         return text, tool_calls, metadata
 
-    def __process_chunk_content(self, chunk: Union[GenerationChunk, AIMessageChunk]):
+    def __estimate_tokens(self, prompt: Optional[str], system: Optional[str], messages: Optional[List[Dict]]) -> int:
+        # about four characters per token, the rate limiter settles the estimate with the billed usage afterwards
+        texts = [prompt or '', system or ''] + [str(message.get('content', '')) for message in messages or []]
+        return sum(len(text) for text in texts) // 4
+
+    @staticmethod
+    def __mark_accounted() -> None:
+        accounted = _INVOKE_ACCOUNTED.get()
+        if accounted is not None:
+            accounted[0] = True
+
+    def __first_token(self, current: Any, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        LLM_TIME_TO_FIRST_TOKEN.observe(elapsed, model_id=self.model_id)
+        current.set(**{'llm.time_to_first_token': elapsed})
+
+    def __stream_finished(
+            self,
+            current: Any,
+            start: float,
+            prompt: Optional[str],
+            system: Optional[str],
+            messages: Optional[List[Dict]],
+            parts: list[str],
+            reported: Optional[tuple[int, int]],
+            error: Optional[BaseException],
+            estimate: int
+    ) -> None:
+        LLM_IN_FLIGHT.dec(model_id=self.model_id)
+        LLM_LATENCY.observe(time.perf_counter() - start, model_id=self.model_id)
+        usage = self._record_usage(prompt, system, messages, ''.join(parts), reported)
+        get_limiter(self.model_id).settle(estimate, sum(usage) if usage is not None else estimate)
+        current.set(**self.__span_usage(usage))
+        end_span(current, self.call_id, error)
+
+    @staticmethod
+    def __span_usage(usage: Optional[tuple[int, int]]) -> dict[str, int]:
+        if usage is None:
+            return {}
+        return {'llm.prompt_tokens': usage[0], 'llm.completion_tokens': usage[1]}
+
+    @staticmethod
+    def __chunk_text(chunk: Union[GenerationChunk, AIMessageChunk]) -> str:
         if isinstance(chunk, GenerationChunk):
-            self._update_token_counter_completion(chunk.text)
+            return chunk.text
+        elif isinstance(chunk, AIMessageChunk) and isinstance(chunk.content, str):
+            return chunk.content
+        return ''
+
+    @staticmethod
+    def __chunk_usage(chunk: Union[GenerationChunk, AIMessageChunk]) -> Optional[tuple[int, int]]:
+        # Bedrock sends the invocation metrics with the last chunk of the stream
+        if isinstance(chunk, GenerationChunk):
+            return _reported_usage((chunk.generation_info or {}).get('usage_metadata'))
         elif isinstance(chunk, AIMessageChunk):
-            self._update_token_counter_completion(chunk.content)
+            return _reported_usage(chunk.usage_metadata)
+        return None
 
     def _prepare_input_and_invoke_stream(
             self,
@@ -95,120 +241,151 @@ class ChatBedrockWrapper(ChatBedrock):
             run_manager: Optional[CallbackManagerForLLMRun] = None,
             **kwargs: Any,
     ) -> Iterator[Union[GenerationChunk, AIMessageChunk]]:
-        self._update_token_counter_prompt(prompt, system, messages)
-        stream = super()._prepare_input_and_invoke_stream(prompt, system, messages, stop, run_manager, **kwargs)
+        check_cancelled(self.call_id)
+        estimate = self.__estimate_tokens(prompt, system, messages)
+        invoke_stream = super()._prepare_input_and_invoke_stream
+        # rate limited, and retried until the first chunk arrives
+        stream = get_limiter(self.model_id).stream(
+            self.call_id, estimate, lambda: invoke_stream(prompt, system, messages, stop, run_manager, **kwargs)
+        )
+        current = start_span('bedrock.stream', 'llm', self.call_id, **{'llm.model_id': self.model_id})
         def inner() -> Iterator[Union[GenerationChunk, AIMessageChunk]]:
-            for chunk in stream:
-                self.__process_chunk_content(chunk)
-                yield chunk
+            # the request is accounted for once, when the stream ends or is abandoned
+            start = time.perf_counter()
+            LLM_IN_FLIGHT.inc(model_id=self.model_id)
+            tokens = AnswerTokens(self.call_id) if has_listener(self.call_id) else None
+            parts = []
+            reported = None
+            error = None
+            try:
+                for chunk in stream:
+                    # stop reading (and paying for) the completion of a cancelled call
+                    check_cancelled(self.call_id)
+                    text = self.__chunk_text(chunk)
+                    if text and not any(parts):
+                        self.__first_token(current, start)
+                    if text and tokens is not None:
+                        tokens.add(text)
+                    parts.append(text)
+                    reported = self.__chunk_usage(chunk) or reported
+                    yield chunk
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self.__stream_finished(current, start, prompt, system, messages, parts, reported, error, estimate)
         return inner()
 
     async def _aprepare_input_and_invoke_stream(
             self,
             prompt: str,
+            system: Optional[str] = None,
+            messages: Optional[List[Dict]] = None,
             stop: Optional[List[str]] = None,
             run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
             **kwargs: Any,
-    ) -> AsyncIterator[GenerationChunk]:
-        self._update_token_counter_prompt(prompt, None, None)
-        stream = super()._aprepare_input_and_invoke_stream(prompt, stop, run_manager, **kwargs)
-
-        async def inner() -> AsyncIterator[GenerationChunk]:
-            async for chunk in stream:
-                self._update_token_counter_completion(chunk.text)
+    ) -> AsyncIterator[Union[GenerationChunk, AIMessageChunk]]:
+        check_cancelled(self.call_id)
+        # an async generator like the one it overrides, callers iterate it with `async for`
+        current = start_span('bedrock.stream', 'llm', self.call_id, **{'llm.model_id': self.model_id})
+        start = time.perf_counter()
+        LLM_IN_FLIGHT.inc(model_id=self.model_id)
+        tokens = AnswerTokens(self.call_id) if has_listener(self.call_id) else None
+        estimate = self.__estimate_tokens(prompt, system, messages)
+        invoke_stream = super()._aprepare_input_and_invoke_stream
+        parts = []
+        reported = None
+        error = None
+        try:
+            async for chunk in get_limiter(self.model_id).astream(
+                    self.call_id, estimate, lambda: invoke_stream(prompt, system, messages, stop, run_manager, **kwargs)
+            ):
+                check_cancelled(self.call_id)
+                text = self.__chunk_text(chunk)
+                if text and not any(parts):
+                    self.__first_token(current, start)
+                if text and tokens is not None:
+                    tokens.add(text)
+                parts.append(text)
+                reported = self.__chunk_usage(chunk) or reported
                 yield chunk
-
-        return inner()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.__stream_finished(current, start, prompt, system, messages, parts, reported, error, estimate)
+
+    def count_tokens(self, text: str) -> int:
+        """`get_num_tokens` memoized on the content hash, so the growing conversation history is not re-tokenized at
+        every agent step."""
+        if not text:
+            return 0
+        key = (self.model_id, hashlib.blake2b(text.encode(), digest_size=16).digest())
+        return TOKEN_COUNT_CACHE.get_or_compute(key, lambda: self.get_num_tokens(text))
+
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """The token counts of `texts`, like `count_tokens`: every distinct text is looked up in `TOKEN_COUNT_CACHE`
+        once, and only the ones missing there are tokenized."""
+        counts: dict[str, int] = {}
+        for text in dict.fromkeys(texts):
+            if not text:
+                counts[text] = 0
+                continue
+            key = (self.model_id, hashlib.blake2b(text.encode(), digest_size=16).digest())
+            count = TOKEN_COUNT_CACHE.get(key)
+            if count is None:
+                count = self.get_num_tokens(text)
+                TOKEN_COUNT_CACHE.put(key, count)
+            counts[text] = count
+        return [counts[text] for text in texts]
 
     def __get_tokens_count(self, prompt: Optional[str], system: Optional[str], messages: Optional[List[Dict]]) -> int:
-        tokens = 0
-        if prompt is not None:
-            tokens += self.get_num_tokens(prompt)
-        if system is not None:
-            tokens += self.get_num_tokens(system)
+        texts = [text for text in (prompt, system) if text is not None]
         if messages:
             for message in messages:
                 content = message['content']
                 if isinstance(content, list):
                     for elem in content:
                         if 'input' in elem:
-                            tokens += self.get_num_tokens(str(elem['input']))
+                            texts.append(str(elem['input']))
                         if 'output' in elem:
-                            tokens += self.get_num_tokens(str(elem['output']))
+                            texts.append(str(elem['output']))
                 elif isinstance(content, str):
-                    tokens += self.get_num_tokens(content)
+                    texts.append(content)
                 else:
                     print(f'error: unrecognised message content: {content}. Treating everything as a str')
-                    tokens += self.get_num_tokens(str(content))
-        return tokens
-
-    def _update_token_counter_prompt(self, prompt, system, messages):
-        tokens = self.__get_tokens_count(prompt, system, messages)
-        if self.model_id not in TOKEN_COUNTER[self.call_id]:
-            TOKEN_COUNTER[self.call_id][self.model_id] = _empty_metrics()
-        TOKEN_COUNTER[self.call_id][self.model_id]['total_tokens'] += tokens
-        TOKEN_COUNTER[self.call_id][self.model_id]['prompt_tokens'] += tokens
-        TOKEN_COUNTER[self.call_id][self.model_id]['successful_requests'] += 1
-        TOKEN_COUNTER[self.call_id][self.model_id]['total_cost'] += get_token_cost(
-            tokens=tokens,
-            model_id=self.model_id,
-            mode='prompt'
-        )
-
-    def _update_token_counter_completion(self, text):
-        tokens = self.get_num_tokens(text)
-        if self.model_id not in TOKEN_COUNTER[self.call_id]:
-            TOKEN_COUNTER[self.call_id][self.model_id] = _empty_metrics()
-        TOKEN_COUNTER[self.call_id][self.model_id]['total_tokens'] += tokens
-        TOKEN_COUNTER[self.call_id][self.model_id]['completion_tokens'] += tokens
-        TOKEN_COUNTER[self.call_id][self.model_id]['total_cost'] += get_token_cost(
-            tokens=tokens,
-            model_id=self.model_id,
-            mode='completion'
-        )
-
-
-def get_token_cost(tokens: int, model_id: str, mode: str) -> float:
-    assert mode in ['prompt', 'completion', 'input', 'output'], f'mode "{mode}" is not supported'
-    cost_mapping = {
-        'anthropic.claude-3-5-sonnet-20240620-v1:0': {'input': 0.003, 'output': 0.015},
-        'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125},
-        'amazon.titan-text-premier-v1:0': {'input': 0.0005, 'output': 0.0015},
-        'meta.llama3-8b-instruct-v1:0': {'input': 0.0003, 'output': 0.0006},
-        'meta.llama3-70b-instruct-v1:0': {'input': 0.00265, 'output': 0.0035},
-        'mistral.mistral-7b-instruct-v0:2': {'input': 0.00015, 'output': 0.0002},
-        'mistral.mixtral-8x7b-instruct-v0:1': {'input': 0.00045, 'output': 0.0007}
-    }
-    if mode == 'prompt':
-        mode = 'input'
-    elif mode == 'completion':
-        mode = 'output'
-    return tokens / 1000 * cost_mapping[model_id][mode]
+                    texts.append(str(content))
+        # the tool outputs and observations of an agent repeat across its messages, each is tokenized once
+        return sum(self.count_tokens_batch(texts))
 
-
-def compute_llm_call_cost(model_id: str, call_id: str) -> float:
-    logging.info(f"Starting cost computation for model: {model_id}, call ID: {call_id}")
-
-    # Mapping of model names to their respective costs per 1,000 tokens (input and output)
-    cost_mapping = {
-        'anthropic.claude-3-5-sonnet-20240620-v1:0': {'input': 0.003, 'output': 0.015},
-        'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125},
-        'amazon.titan-text-premier-v1:0': {'input': 0.0005, 'output': 0.0015}
-    }
-
-    token_counts = TOKEN_COUNTER[str(call_id)][model_id]
-    prompt_tokens = token_counts['prompt_tokens']
-    completion_tokens = token_counts['completion_tokens']
-
-    logging.info(f"Token counts - Prompt: {prompt_tokens}, Completion: {completion_tokens}")
-
-    input_cost = (prompt_tokens / 1000) * cost_mapping[model_id]['input']
-    output_cost = (completion_tokens / 1000) * cost_mapping[model_id]['output']
-
-    logging.info(f"Input cost: ${input_cost}, Output cost: ${output_cost}")
-
-    total_cost = input_cost + output_cost
-
-    logging.info(f"Total cost for call ID {call_id}: ${total_cost}")
-
-    return total_cost
+    def _record_usage(
+            self,
+            prompt: Optional[str],
+            system: Optional[str],
+            messages: Optional[List[Dict]],
+            completion: str,
+            reported: Optional[tuple[int, int]]
+    ) -> Optional[tuple[int, int]]:
+        """Accounts for the request and returns the (prompt tokens, completion tokens) billed, or the reported usage
+        if the call is not accounted for."""
+        self.__mark_accounted()
+        accounting = TOKEN_COUNTER.get(self.call_id)
+        if accounting is None:
+            return reported
+
+        if reported is not None and self.token_usage_mode != 'estimated':
+            accounting.add_usage(self.model_id, *reported)
+            if self.token_usage_mode == 'reconcile':
+                accounting.add_reconciliation(
+                    self.model_id, *reported, self.__get_tokens_count(prompt, system, messages),
+                    self.__count_completion(completion)
+                )
+            return reported
+
+        usage = self.__get_tokens_count(prompt, system, messages), self.__count_completion(completion)
+        accounting.add_usage(self.model_id, *usage, estimated=True)
+        return usage
+
+    def __count_completion(self, text: str) -> int:
+        # completions are counted once and never seen again, caching them would only evict the prompt history
+        return self.get_num_tokens(text) if text else 0
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from pathlib import Path
+from typing import Callable, Optional
+
+import dotenv
+
+from src.static.submission import Submission
+from src.static.submission_pool import PooledSubmission
+from src.static.util import PROJECT_ROOT
+
+dotenv.load_dotenv()
+
+ANSWER_CACHE_PATH = Path(os.environ.get('ANSWER_CACHE_PATH', PROJECT_ROOT.parent / '.cache' / 'answer_cache.sqlite'))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 10_000))
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 24 * 3600))
+# Minimum cosine similarity of the prompt embeddings for a near-identical prompt to be served from the cache, 0
+# disables the similarity tier. Prompts that differ only in a country or a year are very similar, so keep it high.
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0))
+
+__WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Case-folded prompt with collapsed whitespace and without trailing punctuation."""
+    return __WHITESPACE.sub(' ', prompt).strip().rstrip('?!. ').casefold()
+
+
+def hashed_ngram_embedding(text: str, dimensions: int = 512, n: int = 3) -> list[float]:
+    """Local embedding of `text`: its word and character `n`-grams hashed into `dimensions` buckets, L2-normalized."""
+    vector = [0.0] * dimensions
+    padded = f' {text} '
+    features = text.split() + [padded[i:i + n] for i in range(len(padded) - n + 1)]
+    for feature in features:
+        vector[zlib.crc32(feature.encode()) % dimensions] += 1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+
+def submission_config_key(submission: Submission) -> str:
+    """Identifies what produces the answers: the crew class, its model and the agent / task configs. Answers of a
+    different configuration are never served."""
+    if isinstance(submission, PooledSubmission):
+        submission = submission.pool.template()
+    llm = getattr(submission, 'llm', None)
+    config = {
+        'submission': f'{type(submission).__module__}.{type(submission).__qualname__}',
+        'model_id': getattr(llm, 'model_id', None),
+        'model_kwargs': getattr(llm, 'model_kwargs', None),
+        'configs': __CONFIGS_DIGEST,
+        'version': os.environ.get('ANSWER_CACHE_VERSION', '')
+    }
+    return hashlib.blake2b(json.dumps(config, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def __configs_digest() -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted((PROJECT_ROOT / 'submission' / 'config').glob('*.yaml')):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+__CONFIGS_DIGEST = __configs_digest()
+
+
+class AnswerCache:
+    """Answers of `/run` persisted in a local SQLite file, looked up by the normalized prompt and, if
+    `similarity_threshold` is set, by the most similar cached prompt of the same configuration.
+
+    Entries expire `ttl` seconds after they were stored, the least recently used entries are evicted beyond
+    `max_size`. A `max_size` or `ttl` of 0 disables the cache.
+    """
+
+    def __init__(
+            self,
+            path: Path = ANSWER_CACHE_PATH,
+            max_size: int = ANSWER_CACHE_SIZE,
+            ttl: Optional[float] = ANSWER_CACHE_TTL,
+            similarity_threshold: float = ANSWER_CACHE_SIMILARITY,
+            embed: Callable[[str], list[float]] = hashed_ngram_embedding
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.__connection: Optional[sqlite3.Connection] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and (self.ttl is None or self.ttl > 0)
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    config_key TEXT NOT NULL,
+                    prompt_key TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    embedding BLOB,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    PRIMARY KEY (config_key, prompt_key)
+                )
+            """)
+            connection.execute('CREATE INDEX IF NOT EXISTS answers_used_at ON answers (used_at)')
+            self.__connection = connection
+        return self.__connection
+
+    def __min_created_at(self) -> float:
+        return time.time() - self.ttl if self.ttl is not None else float('-inf')
+
+    def get(self, config_key: str, prompt: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        prompt_key = normalize_prompt(prompt)
+        with self.__lock:
+            connection = self.__connect()
+            row = connection.execute(
+                'SELECT answer, prompt_key FROM answers WHERE config_key = ? AND prompt_key = ? AND created_at >= ?',
+                (config_key, prompt_key, self.__min_created_at())
+            ).fetchone()
+            if row is None and self.similarity_threshold > 0:
+                row = self.__most_similar(connection, config_key, prompt_key)
+                self.similar_hits += row is not None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            connection.execute(
+                'UPDATE answers SET used_at = ? WHERE config_key = ? AND prompt_key = ?',
+                (time.time(), config_key, row[1])
+            )
+            return row[0]
+
+    def __most_similar(self, connection: sqlite3.Connection, config_key: str, prompt_key: str) -> Optional[tuple]:
+        embedding = self.embed(prompt_key)
+        best, best_similarity = None, self.similarity_threshold
+        rows = connection.execute(
+            'SELECT answer, prompt_key, embedding FROM answers '
+            'WHERE config_key = ? AND created_at >= ? AND embedding IS NOT NULL',
+            (config_key, self.__min_created_at())
+        )
+        for answer, other_key, blob in rows:
+            other = array('f')
+            other.frombytes(blob)
+            similarity = sum(a * b for a, b in zip(embedding, other))
+            if similarity >= best_similarity:
+                best, best_similarity = (answer, other_key), similarity
+        return best
+
+    def put(self, config_key: str, prompt: str, answer: str) -> None:
+        if not self.enabled:
+            return
+        prompt_key = normalize_prompt(prompt)
+        embedding = array('f', self.embed(prompt_key)).tobytes() if self.similarity_threshold > 0 else None
+        now = time.time()
+        with self.__lock:
+            connection = self.__connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)',
+                (config_key, prompt_key, answer, embedding, now, now)
+            )
+            connection.execute('DELETE FROM answers WHERE created_at < ?', (self.__min_created_at(),))
+            connection.execute(
+                'DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_size,)
+            )
+
+    def invalidate(self) -> int:
+        if not self.enabled:
+            return 0
+        with self.__lock:
+            return self.__connect().execute('DELETE FROM answers').rowcount
+
+    def stats(self) -> dict[str, int | float]:
+        with self.__lock:
+            size = self.__connect().execute('SELECT COUNT(*) FROM answers').fetchone()[0] if self.enabled else 0
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'similar_hits': self.similar_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+ANSWER_CACHE = AnswerCache()
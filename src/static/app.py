@@ -1,26 +1,120 @@
 import asyncio
 import datetime as dt
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import logging
+import math
+import os
 import random
+import threading
+import time
+from typing import AsyncIterator, Optional
 import dotenv
 import uvicorn
 
 from async_timeout import timeout
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from src.submission.create_submission import create_submission
-from src.static.ChatBedrockWrapper import TOKEN_COUNTER, get_total_number_of_tokens, get_total_cost, get_token_details
+from src.static.token_accounting import TOKEN_COUNTER, CallAccounting, get_total_number_of_tokens, get_total_cost, get_token_details, get_token_reconciliation
+from src.static.answer_cache import ANSWER_CACHE, submission_config_key
+from src.static.bedrock_limiter import bedrock_stats
+from src.static.batch import BATCH_MAX_ITEMS, BATCH_MAX_PARALLELISM, BATCH_PARALLELISM, aggregate, run_batch_items
+from src.static.call_context import start_call, end_call, cancel_call
+from src.static import metrics
+from src.static.util import pool_stats, warm_up_engine
+from src.static.query_cache import QUERY_CACHE, invalidate_query_cache
+from src.static.run_events import format_sse, subscribe, unsubscribe
+from src.static.scheduler import SCHEDULER, SchedulerRejected
+from src.static.submission import Submission
+from src.static.submission_pool import submission_pool_stats, warm_up_pools
+from src.static.tracing import TRACE_EXPORT_PATH, end_trace, get_trace_report, span, start_trace
 
 dotenv.load_dotenv()
+# at import, so the INFO logs also appear when uvicorn imports `src.static.app:app`
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Seconds between keep-alive comments of an idle `/run/stream`, so proxies do not close the connection
+SSE_KEEP_ALIVE = float(os.environ.get('SSE_KEEP_ALIVE', 15))
+
+metrics.register_stats('gdsc_queue_depth', '/run requests waiting for a slot.', SCHEDULER.stats, 'queue_depth')
+metrics.register_stats('gdsc_requests_in_flight', '/run requests holding a slot.', SCHEDULER.stats, 'running')
+metrics.register_stats(
+    'gdsc_query_cache_hits_total', 'Agent queries answered from the query cache.', QUERY_CACHE.stats, 'hits', 'counter'
+)
 
 
 class Payload(BaseModel):
     prompt: str
     timeout: int = 5*60  # 5 minutes
+    priority: int = 0  # requests with a higher priority leave the queue first
+    trace: bool = False  # return the spans of the LLM calls, tool calls and queries of the run, see tracing.py
+
+
+class BatchPayload(BaseModel):
+    prompts: list[str]
+    timeout: int = 5*60  # per prompt
+    priority: int = -1  # behind interactive requests by default
+    parallelism: int = BATCH_PARALLELISM  # prompts running at once, at most BATCH_MAX_PARALLELISM
+    trace: bool = False
+
+
+# Set once `warm_up` is done, see `/ready`
+READY = threading.Event()
+
+
+def load_create_submission():
+    # crewai and langchain are imported with the submission, on first use rather than when the service starts
+    from src.submission.create_submission import create_submission
+    return create_submission
+
+
+def prepare_submission(call_id: str) -> tuple[Submission, str]:
+    submission = load_create_submission()(call_id=call_id)
+    return submission, submission_config_key(submission)
+
+
+def warm_up() -> None:
+    """Imports the submission, builds the pooled crews, loads the questionnaire index, checks the aggregates and opens
+    the database connections, in a worker thread after startup. Requests arriving earlier pay for what is not done yet."""
+    try:
+        load_create_submission()
+        warm_up_pools()
+    except Exception as e:
+        logging.warning(f'Could not pre-build submissions: {e}')
+    try:
+        from src.submission.tools import questionnaire_index
+        questionnaire_index.warm_up()
+    except Exception as e:
+        logging.warning(f'Could not load the questionnaire index: {e}')
+    try:
+        from src.submission.tools import aggregates
+        aggregates.warm_up()
+    except Exception as e:
+        logging.warning(f'Could not check the aggregates: {e}')
+    try:
+        warm_up_engine()
+    except Exception as e:
+        logging.warning(f'Could not pre-warm database connections: {e}')
+    READY.set()
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # crews run in the default executor; it is bounded so that calls still winding down after a timeout cannot pile
+    # up threads without limit
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+        max_workers=int(os.environ.get('RUN_MAX_WORKERS', 2 * SCHEDULER.max_concurrency)),
+        thread_name_prefix='run'
+    ))
+    # the heavy imports and connections are made after startup, so the server accepts requests right away
+    asyncio.get_running_loop().run_in_executor(None, warm_up)
+    yield
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -28,46 +122,316 @@ async def health_check():
     return {"message": "Server is running. You may direct queries to api"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    if not READY.is_set():
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True}
+
+
+@app.get("/pool")
+async def get_pool_stats():
+    return pool_stats()
+
+
+@app.get("/submission-pool")
+async def get_submission_pool_stats():
+    return submission_pool_stats()
+
+
+@app.get("/scheduler")
+async def get_scheduler_stats():
+    return SCHEDULER.stats()
+
+
+@app.get("/bedrock")
+async def get_bedrock_stats():
+    return bedrock_stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@app.get("/cache")
+async def get_cache_stats():
+    return QUERY_CACHE.stats()
+
+
+@app.delete("/cache")
+async def invalidate_cache():
+    return {'invalidated': invalidate_query_cache()}
+
+
+@app.get("/answer-cache")
+async def get_answer_cache_stats():
+    return await asyncio.to_thread(ANSWER_CACHE.stats)
+
+
+@app.delete("/answer-cache")
+async def invalidate_answer_cache():
+    return {'invalidated': await asyncio.to_thread(ANSWER_CACHE.invalidate)}
+
+
+def usage_report(call_id: str) -> dict:
+    ret = {
+        'tokens': get_total_number_of_tokens(call_id),
+        'cost': get_total_cost(call_id),
+        'token_details': get_token_details(call_id)
+    }
+    # only filled with TOKEN_USAGE_MODE=reconcile
+    reconciliation = get_token_reconciliation(call_id)
+    if reconciliation:
+        ret['token_reconciliation'] = reconciliation
+    return ret
+
+
+def trace_report(call_id: str, payload: Payload) -> dict:
+    return {'trace': get_trace_report(call_id)} if payload.trace else {}
+
+
 @app.post("/run")
 async def run_task(payload: Payload):
-    call_id = dt.datetime.now().strftime("%Y%m%d%H%M%S%f") + f'_{random.randint(0, 1_000_000)}'
-    TOKEN_COUNTER[call_id] = {}
+    start_time = time.perf_counter()
+    status = 500
     try:
-        submission = create_submission(call_id=call_id)
+        response = await handle_run(payload)
+        status = response.status_code
+        return response
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - start_time)
+        metrics.REQUESTS.inc(status=str(status))
+
 
-        async def run_submission(prompt: str):
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(None, submission.run, prompt)
+def new_call_id() -> str:
+    return dt.datetime.now().strftime("%Y%m%d%H%M%S%f") + f'_{random.randint(0, 1_000_000)}'
+
+
+async def prepare_run(call_id: str) -> tuple[Submission, str]:
+    try:
+        if READY.is_set():
+            return prepare_submission(call_id)
+        # may still import crewai or build a crew, keep it off the event loop
+        return await asyncio.to_thread(prepare_submission, call_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def cached_answer(config_key: str, payload: Payload) -> Optional[dict]:
+    """The response to a repeated prompt, answered from the cache without taking a slot."""
+    start_time = asyncio.get_event_loop().time()
+    # SQLite I/O and, with the similarity tier, a scan of all entries, kept off the event loop
+    cached = await asyncio.to_thread(ANSWER_CACHE.get, config_key, payload.prompt)
+    if cached is None:
+        return None
+    metrics.CACHE_HITS.inc()
+    return {
+        "result": cached,
+        "time": asyncio.get_event_loop().time() - start_time,
+        "queue_time": 0.0,
+        "timed_out": False,
+        "cache_hit": True,
+        'tokens': 0,
+        'cost': 0.0,
+        'token_details': {}
+    }
+
+
+def rejected_response(e: SchedulerRejected) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={'detail': f'Server is saturated: {e.reason}.'},
+        headers={'Retry-After': str(math.ceil(e.retry_after))}
+    )
+
+
+async def execute_run(payload: Payload) -> dict:
+    """The `/run` response content. Raises `SchedulerRejected` and `HTTPException`."""
+    call_id = new_call_id()
+    submission, config_key = await prepare_run(call_id)
+    cached = await cached_answer(config_key, payload)
+    if cached is not None:
+        return cached
+
+    async with SCHEDULER.slot(payload.priority, payload.timeout) as queue_time:
+        metrics.QUEUE_TIME.observe(queue_time)
+        # the time spent in the queue counts against the request's timeout
+        return await run_admitted(submission, call_id, config_key, payload, payload.timeout - queue_time, queue_time)
+
+
+async def handle_run(payload: Payload) -> JSONResponse:
+    try:
+        return JSONResponse(content=await execute_run(payload))
+    except SchedulerRejected as e:
+        return rejected_response(e)
 
+
+async def run_item(payload: Payload) -> dict:
+    """A prompt of a batch: like `/run`, with rejections and errors reported in the item."""
+    try:
+        return await execute_run(payload)
+    except SchedulerRejected as e:
+        return {'result': None, 'status': 429, 'error': f'Server is saturated: {e.reason}.'}
+    except HTTPException as e:
+        return {'result': None, 'status': e.status_code, 'error': e.detail}
+
+
+@app.post("/run/batch")
+async def run_task_batch(payload: BatchPayload):
+    """Runs the prompts concurrently and streams one JSON line per prompt as it finishes (the `/run` response with
+    the `index` and `prompt` of the item, or its `error` and `status`), then a line with the `aggregate` of the batch.
+
+    Every prompt takes a slot of the scheduler like a `/run` request, at most `parallelism` of them at once, so a
+    batch cannot fill the queue. Closing the connection cancels the prompts still running.
+    """
+    if len(payload.prompts) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f'At most {BATCH_MAX_ITEMS} prompts per batch.')
+    return StreamingResponse(stream_batch(payload), media_type='application/x-ndjson')
+
+
+async def stream_batch(payload: BatchPayload) -> AsyncIterator[str]:
+    start_time = time.perf_counter()
+    items = []
+    async for item in run_batch_items(
+            payload.prompts,
+            lambda prompt: run_item(Payload(
+                prompt=prompt, timeout=payload.timeout, priority=payload.priority, trace=payload.trace
+            )),
+            min(payload.parallelism, BATCH_MAX_PARALLELISM)
+    ):
+        items.append(item)
+        yield json.dumps(item) + '\n'
+    yield json.dumps({'aggregate': aggregate(items, time.perf_counter() - start_time)}) + '\n'
+
+
+@app.post("/run/stream")
+async def run_task_stream(payload: Payload):
+    """Runs the prompt like `/run` and streams Server-Sent Events while it runs: `start` (call id), `admitted` (queue
+    time), the agents' `thought`, `tool_call`, `tool_result` and `task` events, the `token`s of every completion and
+    the `answer` tokens after 'Final Answer:', and finally `result` (the `/run` response) or `error` (status, detail).
+
+    Closing the connection cancels the run.
+    """
+    return StreamingResponse(
+        stream_run(payload),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async def stream_run(payload: Payload) -> AsyncIterator[str]:
+    call_id = new_call_id()
+    # subscribed first, so the LLM of the call streams its completions
+    events = subscribe(call_id)
+    start_time = time.perf_counter()
+    status = 500
+    run = None
+    try:
+        submission, config_key = await prepare_run(call_id)
+        yield format_sse('start', {'call_id': call_id})
+        content = await cached_answer(config_key, payload)
+        if content is None:
+            async with SCHEDULER.slot(payload.priority, payload.timeout) as queue_time:
+                metrics.QUEUE_TIME.observe(queue_time)
+                yield format_sse('admitted', {'queue_time': queue_time})
+                run = asyncio.create_task(run_admitted(
+                    submission, call_id, config_key, payload, payload.timeout - queue_time, queue_time
+                ))
+                get = None
+                while True:
+                    if get is None:
+                        get = asyncio.ensure_future(events.get())
+                    done, _ = await asyncio.wait({run, get}, timeout=SSE_KEEP_ALIVE, return_when=asyncio.FIRST_COMPLETED)
+                    if get in done:
+                        yield format_sse(*get.result())
+                        get = None
+                    elif run in done:
+                        get.cancel()
+                        break
+                    elif not done:
+                        yield ': keep-alive\n\n'
+                for event in events.pending():
+                    yield format_sse(*event)
+                content = run.result()
+        status = 200
+        yield format_sse('result', content)
+    except SchedulerRejected as e:
+        status = 429
+        yield format_sse('error', {
+            'status': 429, 'detail': f'Server is saturated: {e.reason}.', 'retry_after': math.ceil(e.retry_after)
+        })
+    except HTTPException as e:
+        status = e.status_code
+        yield format_sse('error', {'status': e.status_code, 'detail': e.detail})
+    finally:
+        unsubscribe(call_id)
+        if run is not None and not run.done():
+            # the client went away, the run stops the crew like after a timeout
+            run.cancel()
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - start_time)
+        metrics.REQUESTS.inc(status=str(status))
+
+
+async def run_admitted(
+        submission: Submission,
+        call_id: str,
+        config_key: str,
+        payload: Payload,
+        run_timeout: float,
+        queue_time: float
+) -> dict:
+    TOKEN_COUNTER[call_id] = CallAccounting(call_id)
+    start_call(call_id)
+    if payload.trace or TRACE_EXPORT_PATH:
+        start_trace(call_id)
+    try:
         # can raise TimeoutError
-        async with timeout(payload.timeout):
+        async with timeout(run_timeout):
             start_time = asyncio.get_event_loop().time()
-            result = await run_submission(payload.prompt)
+            with span('run', call_id=call_id, **{'run.queue_time': queue_time, 'run.priority': payload.priority}):
+                result = await submission.arun(payload.prompt, call_id=call_id)
             end_time = asyncio.get_event_loop().time()
             time_diff = end_time - start_time
 
-        return JSONResponse(content={
+        if result:
+            await asyncio.to_thread(ANSWER_CACHE.put, config_key, payload.prompt, result)
+        return {
             "result": result,
             "time": time_diff,
+            "queue_time": queue_time,
             "timed_out": False,
-            'tokens': get_total_number_of_tokens(call_id),
-            'cost': get_total_cost(call_id),
-            'token_details': get_token_details(call_id)
-        })
+            "cache_hit": False,
+            **usage_report(call_id),
+            **trace_report(call_id, payload)
+        }
 
     except asyncio.TimeoutError as e:
-        return JSONResponse(content={
+        # stops the Bedrock requests and database queries the abandoned worker thread would still make
+        cancel_call(call_id)
+        metrics.TIMEOUTS.inc()
+        return {
             "result": None,
             "time": None,
+            "queue_time": queue_time,
             "timed_out": True,
-            'tokens': get_total_number_of_tokens(call_id),
-            'cost': get_total_cost(call_id),
-            'token_details': get_token_details(call_id)
-        })
+            "cache_hit": False,
+            **usage_report(call_id),
+            **trace_report(call_id, payload)
+        }
+    except asyncio.CancelledError:
+        # e.g. the client of a stream or batch went away
+        cancel_call(call_id)
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        del TOKEN_COUNTER[call_id]
+        metrics.record_call_usage(TOKEN_COUNTER.pop(call_id))
+        end_call(call_id)
+        end_trace(call_id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+"""Batches of prompts, run concurrently like `/run` requests.
+
+    from src.static.batch import run_batch
+    report = run_batch(['How many students took part in Germany?', ...], parallelism=4)
+
+`run_batch` (and `arun_batch`) run the prompts in this process through the same path as `/run/batch`: the answer cache,
+the scheduler and the accounting of `create_submission`'s crews. The query and questionnaire caches are process-wide,
+so the items of a batch share them.
+"""
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+import dotenv
+
+dotenv.load_dotenv()
+
+BATCH_PARALLELISM = int(os.environ.get('BATCH_PARALLELISM', 4))
+BATCH_MAX_PARALLELISM = int(os.environ.get('BATCH_MAX_PARALLELISM', 16))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1_000))
+
+
+async def run_batch_items(
+        prompts: list[str],
+        run_item: Callable[[str], Awaitable[dict[str, Any]]],
+        parallelism: int = BATCH_PARALLELISM
+) -> AsyncIterator[dict[str, Any]]:
+    """Runs `run_item` on every prompt, at most `parallelism` at once, and yields the results (with the `index` and
+    `prompt` of the item) as they finish. An item that raises is reported with its `error`, closing the iterator
+    cancels the items still running."""
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+
+    async def run(index: int, prompt: str) -> dict[str, Any]:
+        async with semaphore:
+            try:
+                item = await run_item(prompt)
+            except Exception as e:
+                item = {'result': None, 'status': 500, 'error': str(e)}
+        return {'index': index, 'prompt': prompt, **item}
+
+    tasks = [asyncio.create_task(run(index, prompt)) for index, prompt in enumerate(prompts)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def aggregate(items: list[dict[str, Any]], wall_time: float) -> dict[str, Any]:
+    """Totals of the items of a batch. `time` is the sum of the items' run times, `wall_time` that of the batch."""
+    token_details: dict[str, dict[str, int]] = {}
+    for item in items:
+        for model_id, usage in item.get('token_details', {}).items():
+            totals = token_details.setdefault(model_id, {'prompt_tokens': 0, 'completion_tokens': 0})
+            totals['prompt_tokens'] += usage['prompt_tokens']
+            totals['completion_tokens'] += usage['completion_tokens']
+    return {
+        'items': len(items),
+        'succeeded': sum(1 for item in items if item.get('result') is not None),
+        'timed_out': sum(1 for item in items if item.get('timed_out')),
+        'failed': sum(1 for item in items if 'error' in item),
+        'cache_hits': sum(1 for item in items if item.get('cache_hit')),
+        'tokens': sum(item.get('tokens', 0) for item in items),
+        'cost': sum(item.get('cost', 0.0) for item in items),
+        'token_details': token_details,
+        'time': sum(item.get('time') or 0.0 for item in items),
+        'wall_time': wall_time
+    }
+
+
+async def arun_batch(
+        prompts: list[str],
+        parallelism: int = BATCH_PARALLELISM,
+        timeout: int = 5*60,
+        priority: int = 0
+) -> AsyncIterator[dict[str, Any]]:
+    """Yields the result of every prompt as it finishes, see `run_batch`."""
+    # the batch runs the prompts the way the service does
+    from src.static.app import Payload, run_item
+
+    async for item in run_batch_items(
+            prompts, lambda prompt: run_item(Payload(prompt=prompt, timeout=timeout, priority=priority)), parallelism
+    ):
+        yield item
+
+
+def run_batch(
+        prompts: list[str],
+        parallelism: int = BATCH_PARALLELISM,
+        timeout: int = 5*60,
+        on_item: Optional[Callable[[dict[str, Any]], None]] = None
+) -> dict[str, Any]:
+    """Runs the prompts with at most `parallelism` at once and returns `{'items': [...], 'aggregate': {...}}`, the
+    items in the order of the prompts. Every item is like a `/run` response with its `index` and `prompt`, or has an
+    `error` and `status`. `on_item` is called with every item as soon as it finishes. Each prompt times out after
+    `timeout` seconds."""
+    async def main() -> dict[str, Any]:
+        start_time = time.perf_counter()
+        items = []
+        async for item in arun_batch(prompts, parallelism, timeout):
+            items.append(item)
+            if on_item is not None:
+                on_item(item)
+        items.sort(key=lambda item: item['index'])
+        return {'items': items, 'aggregate': aggregate(items, time.perf_counter() - start_time)}
+
+    return asyncio.run(main())
@@ -0,0 +1,360 @@
+"""Client-side layer between `ChatBedrockWrapper` and Bedrock, shared by all calls of the process.
+
+- Rate limiting per `model_id`: token buckets of requests (`BEDROCK_RPM`) and tokens (`BEDROCK_TPM`) per minute, so
+  concurrent runs queue up in the process instead of being throttled by Bedrock. The token bucket is charged with an
+  estimate of the prompt up front and settled with the billed usage once the request is done.
+- Retries of throttled and transient errors with full-jitter exponential backoff (`BEDROCK_MAX_RETRIES`).
+- Single-flight coalescing of identical deterministic (temperature 0) requests: concurrent callers wait for the one
+  request in flight and share its completion. Completions can also be kept in an LRU cache
+  (`BEDROCK_COMPLETION_CACHE_SIZE`, off by default).
+
+Waits check the cancellation of the call, so a timed-out run does not keep waiting for a slot.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Callable, Hashable, Iterator, Optional, TypeVar
+
+import dotenv
+
+from src.static.call_context import CallCancelledError, check_cancelled
+from src.static.metrics import LLM_DEDUPLICATED, LLM_RATE_LIMIT_WAIT, LLM_RETRIES
+from src.static.query_cache import QueryCache
+
+dotenv.load_dotenv()
+
+T = TypeVar('T')
+
+# Requests and tokens (prompt + completion) per minute and model, 0 for no limit. `BEDROCK_RATE_LIMITS` overrides
+# them per model: {"anthropic.claude-3-haiku-20240307-v1:0": {"rpm": 1000, "tpm": 2000000}}
+BEDROCK_RPM = float(os.environ.get('BEDROCK_RPM', 0))
+BEDROCK_TPM = float(os.environ.get('BEDROCK_TPM', 0))
+BEDROCK_RATE_LIMITS: dict[str, dict[str, float]] = json.loads(os.environ.get('BEDROCK_RATE_LIMITS') or '{}')
+BEDROCK_MAX_RETRIES = int(os.environ.get('BEDROCK_MAX_RETRIES', 6))
+BEDROCK_BACKOFF_BASE = float(os.environ.get('BEDROCK_BACKOFF_BASE', 0.5))
+BEDROCK_BACKOFF_MAX = float(os.environ.get('BEDROCK_BACKOFF_MAX', 20))
+BEDROCK_COALESCE = os.environ.get('BEDROCK_COALESCE', 'true').lower() in ('1', 'true', 'yes')
+BEDROCK_COMPLETION_CACHE_SIZE = int(os.environ.get('BEDROCK_COMPLETION_CACHE_SIZE', 0))
+BEDROCK_COMPLETION_CACHE_TTL = float(os.environ.get('BEDROCK_COMPLETION_CACHE_TTL', 3600))
+
+# Error codes of the `bedrock-runtime` API and botocore exceptions worth another attempt
+THROTTLING_ERRORS = {'ThrottlingException', 'TooManyRequestsException'}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {
+    'ServiceUnavailableException', 'InternalServerException', 'ModelNotReadyException',
+    'EndpointConnectionError', 'ConnectTimeoutError', 'ReadTimeoutError', 'ConnectionClosedError'
+}
+
+# Longest single sleep while waiting, so a cancelled call stops waiting soon
+_WAIT_SLICE = 0.25
+
+
+def retryable_error(error: BaseException) -> Optional[str]:
+    """The name of the retryable error behind `error`, or None. `ChatBedrock` re-raises the client errors as
+    `ValueError('Error raised by bedrock service: ...')`, the original is its context."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        code = (getattr(error, 'response', None) or {}).get('Error', {}).get('Code')
+        for name in (code, type(error).__name__):
+            if name in RETRYABLE_ERRORS:
+                return name
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def backoff(attempt: int) -> float:
+    """Full jitter: uniform between 0 and the exponential bound, so retrying callers spread out."""
+    return random.uniform(0, min(BEDROCK_BACKOFF_MAX, BEDROCK_BACKOFF_BASE * 2 ** attempt))
+
+
+def _sleep(seconds: float, call_id: Optional[str]) -> None:
+    deadline = time.monotonic() + seconds
+    while (remaining := deadline - time.monotonic()) > 0:
+        check_cancelled(call_id)
+        time.sleep(min(remaining, _WAIT_SLICE))
+    check_cancelled(call_id)
+
+
+async def _asleep(seconds: float, call_id: Optional[str]) -> None:
+    deadline = time.monotonic() + seconds
+    while (remaining := deadline - time.monotonic()) > 0:
+        check_cancelled(call_id)
+        await asyncio.sleep(min(remaining, _WAIT_SLICE))
+    check_cancelled(call_id)
+
+
+class TokenBucket:
+    """`per_minute` tokens per minute, of which at most a minute's worth are banked. A reservation always succeeds
+    and may leave the bucket in debt, the reserving caller waits until its share is refilled, so waiters are served in
+    the order they reserved."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.__tokens = per_minute
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` tokens (at most the capacity) and returns the seconds until they are available."""
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= min(amount, self.capacity)
+            return max(0.0, -self.__tokens / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Takes `amount` more tokens (or gives them back if negative), without waiting."""
+        with self.__lock:
+            self.__refill()
+            self.__tokens = min(self.capacity, self.__tokens - amount)
+
+
+class BedrockLimiter:
+    """Rate limits, retries and statistics of the requests to one model."""
+
+    def __init__(self, model_id: str, rpm: float = 0, tpm: float = 0):
+        self.model_id = model_id
+        self.requests_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.__lock = threading.Lock()
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def __reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests_bucket is not None:
+            wait = max(wait, self.requests_bucket.reserve(1))
+        if self.tokens_bucket is not None:
+            wait = max(wait, self.tokens_bucket.reserve(tokens))
+        with self.__lock:
+            self.requests += 1
+            if wait > 0:
+                self.waits += 1
+                self.wait_time += wait
+                self.max_wait_time = max(self.max_wait_time, wait)
+        if wait > 0:
+            LLM_RATE_LIMIT_WAIT.observe(wait, model_id=self.model_id)
+        return wait
+
+    def acquire(self, tokens: int, call_id: Optional[str]) -> None:
+        """Waits for a request slot and `tokens` (estimated prompt tokens) of the model's limits."""
+        wait = self.__reserve(tokens)
+        if wait > 0:
+            _sleep(wait, call_id)
+
+    async def aacquire(self, tokens: int, call_id: Optional[str]) -> None:
+        wait = self.__reserve(tokens)
+        if wait > 0:
+            await _asleep(wait, call_id)
+
+    def settle(self, estimated: int, billed: int) -> None:
+        """Corrects the token bucket by the difference between the estimate taken up front and the billed usage."""
+        if self.tokens_bucket is not None:
+            self.tokens_bucket.adjust(billed - estimated)
+
+    def __retry_delay(self, error: BaseException, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying after `error`, or None if it is not retried."""
+        name = retryable_error(error)
+        if name is None or attempt >= BEDROCK_MAX_RETRIES:
+            with self.__lock:
+                self.failures += 1
+            return None
+        with self.__lock:
+            self.retries += 1
+            self.throttled += name in THROTTLING_ERRORS
+        LLM_RETRIES.inc(model_id=self.model_id, error=name)
+        return backoff(attempt)
+
+    def call(self, call_id: Optional[str], tokens: int, request: Callable[[], T]) -> T:
+        """Runs `request` within the limits, retrying throttled and transient errors."""
+        attempt = 0
+        while True:
+            self.acquire(tokens, call_id)
+            try:
+                return request()
+            except Exception as e:
+                delay = self.__retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            _sleep(delay, call_id)
+            attempt += 1
+
+    def stream(self, call_id: Optional[str], tokens: int, request: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """Like `call` for a streamed response. The request is only retried until its first chunk arrives, after that
+        the chunks are already passed on."""
+        attempt = 0
+        while True:
+            self.acquire(tokens, call_id)
+            stream = request()
+            try:
+                first = next(stream)
+            except StopIteration:
+                return
+            except Exception as e:
+                delay = self.__retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                _sleep(delay, call_id)
+                attempt += 1
+                continue
+            yield first
+            yield from stream
+            return
+
+    async def astream(
+            self, call_id: Optional[str], tokens: int, request: Callable[[], AsyncIterator[T]]
+    ) -> AsyncIterator[T]:
+        attempt = 0
+        while True:
+            await self.aacquire(tokens, call_id)
+            stream = request()
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                delay = self.__retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await _asleep(delay, call_id)
+                attempt += 1
+                continue
+            yield first
+            async for chunk in stream:
+                yield chunk
+            return
+
+    def deduplicated(self, source: str) -> None:
+        with self.__lock:
+            if source == 'cache':
+                self.cache_hits += 1
+            else:
+                self.coalesced += 1
+        LLM_DEDUPLICATED.inc(model_id=self.model_id, source=source)
+
+    def stats(self) -> dict[str, int | float]:
+        with self.__lock:
+            return {
+                'requests': self.requests,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'failures': self.failures,
+                'coalesced': self.coalesced,
+                'cache_hits': self.cache_hits,
+                'rpm': self.requests_bucket.capacity if self.requests_bucket is not None else 0,
+                'tpm': self.tokens_bucket.capacity if self.tokens_bucket is not None else 0
+            }
+
+
+class SingleFlight:
+    """Runs one `compute` per key at a time, concurrent callers with the same key wait for it and share the result."""
+
+    def __init__(self):
+        self.__calls: dict[Hashable, Future] = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key: Hashable, compute: Callable[[], T], call_id: Optional[str]) -> tuple[T, bool]:
+        """Returns the result and whether it was shared from another caller's `compute`."""
+        with self.__lock:
+            future = self.__calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.__calls[key] = Future()
+        if leader:
+            try:
+                value = compute()
+                future.set_result(value)
+                return value, False
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self.__lock:
+                    self.__calls.pop(key, None)
+
+        while True:
+            check_cancelled(call_id)
+            try:
+                return future.result(timeout=_WAIT_SLICE), True
+            except TimeoutError:
+                continue
+            except CallCancelledError:
+                # the call that made the request was cancelled, not this one
+                return self.do(key, compute, call_id)
+
+
+_LIMITERS: dict[str, BedrockLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+_IN_FLIGHT = SingleFlight()
+# request key -> completion of a deterministic request
+COMPLETION_CACHE = QueryCache(max_size=BEDROCK_COMPLETION_CACHE_SIZE, ttl=BEDROCK_COMPLETION_CACHE_TTL)
+
+
+def get_limiter(model_id: str) -> BedrockLimiter:
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(model_id)
+        if limiter is None:
+            limits = BEDROCK_RATE_LIMITS.get(model_id, {})
+            limiter = _LIMITERS[model_id] = BedrockLimiter(
+                model_id, limits.get('rpm', BEDROCK_RPM), limits.get('tpm', BEDROCK_TPM)
+            )
+        return limiter
+
+
+def request_key(model_id: str, params: dict[str, Any], **request: Any) -> Optional[str]:
+    """A key of the request if its completion is deterministic (temperature 0), otherwise None."""
+    if params.get('temperature') != 0:
+        return None
+    body = json.dumps({'model_id': model_id, 'params': params, **request}, sort_keys=True, default=str)
+    return hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+
+
+def deduplicated_call(
+        limiter: BedrockLimiter, call_id: Optional[str], key: Optional[str], request: Callable[[], T]
+) -> tuple[T, str]:
+    """Runs `request` (already limited and retried) unless its completion is cached or being computed for another
+    caller. Returns the result and where it came from: 'bedrock', 'coalesced' or 'cache'."""
+    if key is None or not BEDROCK_COALESCE:
+        return request(), 'bedrock'
+    sentinel = object()
+    cached = COMPLETION_CACHE.get(key, sentinel)
+    if cached is not sentinel:
+        limiter.deduplicated('cache')
+        return cached, 'cache'
+
+    def compute() -> T:
+        value = request()
+        COMPLETION_CACHE.put(key, value)
+        return value
+
+    value, shared = _IN_FLIGHT.do(key, compute, call_id)
+    if shared:
+        limiter.deduplicated('coalesced')
+        return value, 'coalesced'
+    return value, 'bedrock'
+
+
+def bedrock_stats() -> dict[str, dict[str, int | float]]:
+    with _LIMITERS_LOCK:
+        limiters = list(_LIMITERS.values())
+    return {limiter.model_id: limiter.stats() for limiter in limiters}
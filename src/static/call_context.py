@@ -0,0 +1,115 @@
+import contextlib
+import threading
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+
+class CallCancelledError(BaseException):
+    """Raised inside a call that was cancelled, e.g. because its request timed out.
+
+    Derives from `BaseException` (like `asyncio.CancelledError`), so the `except Exception` handlers of the agents and
+    tools do not turn it into an observation the agent keeps working on.
+    """
+
+
+class _CallState:
+    __slots__ = ('cancelled', 'connections', 'lock')
+
+    def __init__(self):
+        self.cancelled = False
+        # DBAPI connections currently executing a statement for the call
+        self.connections: set[Any] = set()
+        self.lock = threading.Lock()
+
+
+# Calls in progress, registered by whoever owns the call (see app.py). Calls that are not registered, e.g. when a
+# crew is run from a script, can never be cancelled.
+_CALLS: dict[str, _CallState] = {}
+
+# The call the current thread / task works on. Set by `Submission.arun` and copied into the worker thread, so code
+# that does not get the call id passed (e.g. the database tools) knows which call it belongs to. The state is bound
+# itself, so a worker still running after `end_call` keeps seeing the cancellation.
+_CURRENT_CALL: ContextVar[Optional[tuple[str, Optional[_CallState]]]] = ContextVar('_CURRENT_CALL', default=None)
+
+
+def start_call(call_id: str) -> None:
+    _CALLS[call_id] = _CallState()
+
+
+def end_call(call_id: str) -> None:
+    _CALLS.pop(call_id, None)
+
+
+def cancel_call(call_id: str) -> None:
+    """Marks the call as cancelled and cancels the statements it is running in the database. The work of the call
+    stops at its next Bedrock request, tool call or fetched batch of rows."""
+    state = _CALLS.get(call_id)
+    if state is None:
+        return
+    with state.lock:
+        state.cancelled = True
+        connections = list(state.connections)
+    for connection in connections:
+        # psycopg2 sends a cancel request to the server, sqlite3 interrupts the running statement
+        cancel = getattr(connection, 'cancel', None) or getattr(connection, 'interrupt', None)
+        if cancel is not None:
+            try:
+                cancel()
+            except Exception:
+                pass
+
+
+@contextlib.contextmanager
+def bind_call(call_id: Optional[str]) -> Iterator[None]:
+    """Makes `call_id` the current call of the body (and of the threads started with a copy of its context)."""
+    token = _CURRENT_CALL.set((call_id, _CALLS.get(call_id)) if call_id is not None else None)
+    try:
+        yield
+    finally:
+        _CURRENT_CALL.reset(token)
+
+
+def current_call_id() -> Optional[str]:
+    current = _CURRENT_CALL.get()
+    return current[0] if current is not None else None
+
+
+def __state(call_id: Optional[str]) -> tuple[Optional[str], Optional[_CallState]]:
+    """The bound current call, or `call_id` if no call is bound (e.g. in a thread started without the context)."""
+    current = _CURRENT_CALL.get()
+    if current is not None and (call_id is None or current[0] == call_id):
+        return current
+    return call_id, _CALLS.get(call_id)
+
+
+def is_cancelled(call_id: Optional[str] = None) -> bool:
+    state = __state(call_id)[1]
+    return state is not None and state.cancelled
+
+
+def check_cancelled(call_id: Optional[str] = None) -> None:
+    call_id, state = __state(call_id)
+    if state is not None and state.cancelled:
+        raise CallCancelledError(call_id)
+
+
+@contextlib.contextmanager
+def cancellable(dbapi_connection: Any) -> Iterator[None]:
+    """Registers `dbapi_connection` with the current call while the body runs, so `cancel_call` can abort the
+    statement it executes."""
+    call_id, state = __state(None)
+    if state is None:
+        yield
+        return
+    with state.lock:
+        if state.cancelled:
+            raise CallCancelledError(call_id)
+        state.connections.add(dbapi_connection)
+    try:
+        yield
+    finally:
+        with state.lock:
+            state.connections.discard(dbapi_connection)
+        # the statement may have failed only because it was cancelled
+        if state.cancelled:
+            raise CallCancelledError(call_id)
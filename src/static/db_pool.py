@@ -0,0 +1,53 @@
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.pool import QueuePool
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how often and how long callers wait for a free connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+    def connect(self):
+        # a caller has to wait when nothing is idle and no more overflow connections may be opened
+        must_wait = self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except sqlalchemy.exc.TimeoutError:
+            with self.__lock:
+                self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if must_wait:
+                with self.__lock:
+                    self.waits += 1
+                    self.wait_time += elapsed
+                    self.max_wait_time = max(self.max_wait_time, elapsed)
+        with self.__lock:
+            self.checkouts += 1
+        return connection
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            'pool_size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+            'timeouts': self.timeouts
+        }
@@ -0,0 +1,219 @@
+"""In-process metrics of the service, rendered in the Prometheus text exposition format by `/metrics`.
+
+Recording is a lock and a few additions per sample; everything else (label formatting, cumulative buckets, values
+read from the caches and the scheduler) is done when the endpoint is scraped.
+"""
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from src.static.token_accounting import CallAccounting
+
+LabelValues = tuple[str, ...]
+
+REQUEST_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+DB_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, str, float]]:
+        """(name suffix, label values, extra label, value) of every sample."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.__values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, str, float]]:
+        with self._lock:
+            values = list(self.__values.items())
+        for key, value in sorted(values):
+            yield '', key, '', value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.__values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        """Counts the body as in progress."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, str, float]]:
+        with self._lock:
+            values = list(self.__values.items())
+        for key, value in sorted(values):
+            yield '', key, '', value
+
+
+class CallbackMetric(Metric):
+    """A counter or gauge whose values are read from `collect` (label values -> value) when scraped, for numbers
+    other parts of the service already keep."""
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            collect: Callable[[], dict[LabelValues, float]],
+            labelnames: tuple[str, ...] = (),
+            type: str = 'gauge'
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self.type = type
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, str, float]]:
+        for key, value in sorted(self.collect().items()):
+            yield '', key, '', value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...], labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (count per bucket, the last one above all bounds, sum)
+        self.__values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.__values.get(key)
+            if entry is None:
+                entry = self.__values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, str, float]]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self.__values.items()]
+        for key, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', key, f'le="{_format_value(bound)}"', cumulative
+            yield '_sum', key, '', total
+            yield '_count', key, '', cumulative
+
+
+REGISTRY: list[Metric] = []
+
+REQUEST_LATENCY = Histogram('gdsc_request_latency_seconds', 'Latency of /run requests.', REQUEST_BUCKETS)
+REQUESTS = Counter('gdsc_requests_total', '/run requests by HTTP status.', ('status',))
+QUEUE_TIME = Histogram('gdsc_queue_time_seconds', 'Time admitted /run requests waited for a slot.', REQUEST_BUCKETS)
+TIMEOUTS = Counter('gdsc_timeouts_total', '/run requests that timed out.')
+CACHE_HITS = Counter('gdsc_cache_hits_total', '/run requests answered from the answer cache.')
+RUNS_IN_FLIGHT = Gauge('gdsc_runs_in_flight', 'Crew runs in progress, including those abandoned after a timeout.')
+
+LLM_LATENCY = Histogram('gdsc_llm_latency_seconds', 'Duration of Bedrock requests.', LLM_BUCKETS, ('model_id',))
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    'gdsc_llm_time_to_first_token_seconds', 'Time to the first completion token of Bedrock requests.', LLM_BUCKETS,
+    ('model_id',)
+)
+LLM_IN_FLIGHT = Gauge('gdsc_llm_requests_in_flight', 'Bedrock requests in progress.', ('model_id',))
+TOKENS = Counter('gdsc_tokens_total', 'Tokens billed, by model and prompt/completion.', ('model_id', 'type'))
+COST = Counter('gdsc_cost_usd_total', 'Cost of the tokens billed in USD, by model.', ('model_id',))
+LLM_RATE_LIMIT_WAIT = Histogram(
+    'gdsc_llm_rate_limit_wait_seconds', 'Time Bedrock requests waited for the client-side rate limit.', LLM_BUCKETS,
+    ('model_id',)
+)
+LLM_RETRIES = Counter('gdsc_llm_retries_total', 'Bedrock requests retried, by model and error.', ('model_id', 'error'))
+LLM_DEDUPLICATED = Counter(
+    'gdsc_llm_deduplicated_total', 'Completions shared without a Bedrock request, by model and source.',
+    ('model_id', 'source')
+)
+
+DB_QUERY_LATENCY = Histogram('gdsc_db_query_latency_seconds', 'Duration of agent database queries.', DB_BUCKETS)
+DB_QUERIES_IN_FLIGHT = Gauge('gdsc_db_queries_in_flight', 'Agent database queries in progress.')
+SQL_REJECTED = Counter('gdsc_sql_rejected_total', 'Agent queries rejected by the SQL guard, by reason.', ('reason',))
+SQL_LIMITED = Counter('gdsc_sql_limited_total', 'Agent queries the SQL guard added a LIMIT to.')
+
+
+def record_call_usage(accounting: CallAccounting) -> None:
+    """Adds the tokens and cost of a finished call, from its `TOKEN_COUNTER` entry."""
+    for model_id, usage in list(accounting.models.items()):
+        TOKENS.inc(usage.prompt_tokens, model_id=model_id, type='prompt')
+        TOKENS.inc(usage.completion_tokens, model_id=model_id, type='completion')
+        COST.inc(usage.total_cost, model_id=model_id)
+
+
+def register_stats(name: str, documentation: str, stats: Callable[[], dict], key: str, type: str = 'gauge') -> None:
+    """Exposes `stats()[key]` of a component keeping its own statistics (caches, scheduler, pools)."""
+    CallbackMetric(name, documentation, lambda: {(): float(stats()[key])}, type=type)
+
+
+def render_metrics(registry: Optional[list[Metric]] = None) -> str:
+    return '\n'.join(metric.render() for metric in (registry if registry is not None else REGISTRY)) + '\n'
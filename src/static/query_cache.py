@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# Tokens of a SQL statement: comments, quoted literals/identifiers, numbers, words and everything else
+__SQL_TOKEN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<string>'(?:[^']|'')*')
+    |(?P<identifier>"(?:[^"]|"")*")
+    |(?P<dollar_string>\$(?P<tag>(?:[A-Za-z_][A-Za-z_0-9]*)?)\$.*?\$(?P=tag)\$)
+    |(?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+    |(?P<word>[A-Za-z_][A-Za-z_0-9$]*)
+    |(?P<space>\s+)
+    |(?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+def __normalize_number(number: str) -> str:
+    number, e, exponent = number.lower().partition('e')
+    if e:
+        return f'{__normalize_number(number)}e{exponent}'
+    if '.' not in number:
+        return number.lstrip('0') or '0'
+    integer, fraction = number.split('.', 1)
+    integer = integer.lstrip('0') or '0'
+    # keep the decimal point, `5 / 2.0` and `5 / 2` are not the same query in Postgres
+    fraction = fraction.rstrip('0') or '0'
+    return f'{integer}.{fraction}'
+
+
+def normalize_sql(query: str) -> str:
+    """Returns a canonical form of `query` used as a cache key.
+
+    Comments are dropped, whitespace is collapsed, unquoted words are lower-cased (Postgres folds unquoted
+    identifiers anyway), numeric literals are written in a single form and trailing semicolons are dropped. Quoted
+    and dollar-quoted strings and quoted identifiers are kept verbatim.
+    """
+    tokens = []
+    for match in __SQL_TOKEN.finditer(query):
+        kind, value = match.lastgroup, match.group()
+        if kind in ('comment', 'space'):
+            continue
+        if kind == 'word':
+            value = value.lower()
+        elif kind == 'number':
+            value = __normalize_number(value)
+        tokens.append(value)
+    while tokens and tokens[-1] == ';':
+        tokens.pop()
+    return ' '.join(tokens)
+
+
+class QueryCache:
+    """Thread-safe LRU cache with an optional per-entry TTL, used for results of read-only queries."""
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and (self.ttl is None or self.ttl > 0)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if not self.enabled:
+            return default
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.__entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        with self.__lock:
+            self.__entries[key] = (expires_at, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        if not self.enabled:
+            return compute()
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """Drops all entries, or only those whose key matches `predicate`. Returns the number of dropped entries."""
+        with self.__lock:
+            if predicate is None:
+                dropped = len(self.__entries)
+                self.__entries.clear()
+                return dropped
+            keys = [key for key in self.__entries if predicate(key)]
+            for key in keys:
+                del self.__entries[key]
+            return len(keys)
+
+    def stats(self) -> dict[str, int | float]:
+        with self.__lock:
+            size = len(self.__entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+QUERY_CACHE = QueryCache(
+    max_size=int(os.environ.get('QUERY_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('QUERY_CACHE_TTL', 3600))
+)
+
+
+def invalidate_query_cache() -> int:
+    return QUERY_CACHE.invalidate()
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+from typing import Any, Optional
+
+from src.static.call_context import current_call_id
+from src.static.tracing import record_step, record_task
+
+
+class RunEvents:
+    """Events of a single call for a listener on the event loop (see `/run/stream`), published from any thread."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.__loop = loop
+        self.__queue: asyncio.Queue[tuple[str, dict[str, Any]]] = asyncio.Queue()
+
+    def publish(self, event: str, data: dict[str, Any]) -> None:
+        self.__loop.call_soon_threadsafe(self.__queue.put_nowait, (event, data))
+
+    async def get(self) -> tuple[str, dict[str, Any]]:
+        return await self.__queue.get()
+
+    def pending(self) -> list[tuple[str, dict[str, Any]]]:
+        """The events published so far and not taken yet."""
+        events = []
+        while not self.__queue.empty():
+            events.append(self.__queue.get_nowait())
+        return events
+
+
+# Listeners of the calls in progress, calls nobody listens to publish nothing
+LISTENERS: dict[str, RunEvents] = {}
+_LOCK = threading.Lock()
+
+
+def subscribe(call_id: str) -> RunEvents:
+    events = RunEvents(asyncio.get_running_loop())
+    with _LOCK:
+        LISTENERS[call_id] = events
+    return events
+
+
+def unsubscribe(call_id: str) -> None:
+    with _LOCK:
+        LISTENERS.pop(call_id, None)
+
+
+def has_listener(call_id: Optional[str]) -> bool:
+    return bool(LISTENERS) and call_id in LISTENERS
+
+
+def publish(call_id: Optional[str], event: str, **data: Any) -> None:
+    events = LISTENERS.get(call_id) if LISTENERS else None
+    if events is not None:
+        events.publish(event, data)
+
+
+def format_sse(event: str, data: dict[str, Any]) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def step_callback(step: Any) -> None:
+    """crewai `step_callback` of the crews: traces the agent step and publishes its thought and tool calls."""
+    record_step(step)
+    call_id = current_call_id()
+    if not has_listener(call_id):
+        return
+    if isinstance(step, list):
+        for action, observation in step:
+            publish(call_id, 'thought', text=str(getattr(action, 'log', '')))
+            publish(call_id, 'tool_call', tool=str(getattr(action, 'tool', '')), input=str(getattr(action, 'tool_input', '')))
+            publish(call_id, 'tool_result', tool=str(getattr(action, 'tool', '')), output=str(observation))
+    else:
+        publish(call_id, 'thought', text=str(getattr(step, 'log', '')))
+
+
+def task_callback(output: Any) -> None:
+    """crewai `task_callback` of the crews: traces the task and publishes its output."""
+    record_task(output)
+    publish(
+        current_call_id(), 'task',
+        description=str(getattr(output, 'description', '')),
+        agent=str(getattr(output, 'agent', '')),
+        output=str(getattr(output, 'raw', output))
+    )
+
+
+class AnswerTokens:
+    """Publishes the streamed completion of a ReAct agent as `token` events, and the part after its 'Final Answer:' as
+    `answer` events as well."""
+    MARKER = 'Final Answer:'
+
+    def __init__(self, call_id: str):
+        self.call_id = call_id
+        self.__completion = ''
+        self.__answering = False
+
+    def add(self, text: str) -> None:
+        publish(self.call_id, 'token', text=text)
+        if self.__answering:
+            publish(self.call_id, 'answer', text=text)
+            return
+        # only the end of the completion so far can complete the marker
+        searched = max(0, len(self.__completion) - len(self.MARKER))
+        self.__completion += text
+        index = self.__completion.find(self.MARKER, searched)
+        if index >= 0:
+            self.__answering = True
+            answer = self.__completion[index + len(self.MARKER):].lstrip()
+            if answer:
+                publish(self.call_id, 'answer', text=answer)
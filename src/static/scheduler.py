@@ -0,0 +1,127 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+import time
+from typing import AsyncIterator, Optional
+
+import dotenv
+
+dotenv.load_dotenv()
+
+
+class SchedulerRejected(Exception):
+    """The request was not admitted: the queue is full or the request waited too long for a slot."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RequestScheduler:
+    """Admission control for `/run`: at most `max_concurrency` requests run at once, up to `max_queue_depth` more
+    wait for a slot, served by priority (higher first) and FIFO within a priority.
+
+    A request waits at most `max_queue_wait` seconds (or its own timeout, if shorter), otherwise it is rejected. A
+    full queue rejects right away, so bursts turn into quick 429s instead of thread, DB pool and Bedrock exhaustion.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue_depth: int = 32, max_queue_wait: float = 60):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        # (-priority, sequence number, future resolved once the request owns a slot)
+        self.__queue: list[tuple[int, int, asyncio.Future]] = []
+        self.__sequence = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.__queue)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = 0, timeout: Optional[float] = None) -> AsyncIterator[float]:
+        """Holds a slot while the body runs. Yields the number of seconds spent in the queue, so the caller can count
+        it against its own timeout. Raises `SchedulerRejected` if the request is not admitted."""
+        waited = await self.__acquire(priority, timeout)
+        try:
+            yield waited
+        finally:
+            self.__release()
+
+    async def __acquire(self, priority: int, timeout: Optional[float]) -> float:
+        if self.running < self.max_concurrency and not self.__queue:
+            self.running += 1
+            self.admitted += 1
+            return 0.0
+        if len(self.__queue) >= self.max_queue_depth:
+            self.rejected += 1
+            raise SchedulerRejected('queue is full', retry_after=self.max_queue_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (-priority, next(self.__sequence), future)
+        heapq.heappush(self.__queue, entry)
+        max_wait = self.max_queue_wait if timeout is None else min(self.max_queue_wait, timeout)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before giving up, pass it on
+                self.__release()
+            else:
+                future.cancel()
+                self.__queue.remove(entry)
+                heapq.heapify(self.__queue)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected += 1
+            self.queue_timeouts += 1
+            raise SchedulerRejected('timed out waiting in the queue', retry_after=max_wait)
+        finally:
+            waited = time.perf_counter() - start
+            self.queued += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        self.admitted += 1
+        return waited
+
+    def __release(self) -> None:
+        # the slot goes to the next waiter directly, so `running` only drops when nobody waits
+        while self.__queue:
+            _, _, future = heapq.heappop(self.__queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue_depth': self.max_queue_depth,
+            'running': self.running,
+            'queue_depth': self.queue_depth,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'queue_timeouts': self.queue_timeouts,
+            'queued': self.queued,
+            'wait_time': self.wait_time,
+            'mean_wait_time': self.wait_time / self.queued if self.queued else 0.0,
+            'max_wait_time': self.max_wait_time
+        }
+
+
+SCHEDULER = RequestScheduler(
+    max_concurrency=int(os.environ.get('RUN_MAX_CONCURRENCY', 8)),
+    max_queue_depth=int(os.environ.get('RUN_MAX_QUEUE_DEPTH', 32)),
+    max_queue_wait=float(os.environ.get('RUN_MAX_QUEUE_WAIT', 60))
+)
@@ -0,0 +1,194 @@
+"""Local columnar snapshot of the PIRLS database, queried with DuckDB instead of Postgres.
+
+    python -m src.static.snapshot [--path .cache/pirls_snapshot]
+
+exports every PIRLS table from the Postgres database (`DB_URL` or the `DB_*` settings) to a Parquet file in
+`SNAPSHOT_PATH`. A deployment with `DB_BACKEND=duckdb` then runs all queries of the tools, the questionnaire index and
+the aggregates on these files with an embedded DuckDB, without a round trip to Postgres. The survey data does not
+change, so a snapshot is exported once per dataset.
+"""
+import argparse
+import atexit
+import csv
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Optional
+
+import dotenv
+
+from src.static.util import PROJECT_ROOT
+
+dotenv.load_dotenv()
+
+SNAPSHOT_PATH = Path(os.environ.get('SNAPSHOT_PATH', PROJECT_ROOT.parent / '.cache' / 'pirls_snapshot'))
+# Rows read from Postgres per round trip while exporting
+SNAPSHOT_FETCH_SIZE = int(os.environ.get('SNAPSHOT_FETCH_SIZE', 50_000))
+# Threads of every DuckDB connection, by default DuckDB uses all cores for a single query
+DUCKDB_THREADS = int(os.environ.get('DUCKDB_THREADS', 0))
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT', '')
+
+SNAPSHOT_TABLES = (
+    'Countries', 'Schools', 'Homes', 'Students', 'Teachers', 'StudentTeachers', 'Curricula', 'Benchmarks',
+    'StudentScoreEntries', 'StudentScoreResults',
+    'StudentQuestionnaireEntries', 'StudentQuestionnaireAnswers',
+    'HomeQuestionnaireEntries', 'HomeQuestionnaireAnswers',
+    'SchoolQuestionnaireEntries', 'SchoolQuestionnaireAnswers',
+    'TeacherQuestionnaireEntries', 'TeacherQuestionnaireAnswers',
+    'CurriculumQuestionnaireEntries', 'CurriculumQuestionnaireAnswers',
+)
+MANIFEST = 'manifest.json'
+# NULL in the intermediate CSV files, an empty string stays an empty string
+__NULL = '\\N'
+
+
+def _column_type(kinds: set[type]) -> str:
+    """DuckDB type of a column from the Python types of its values."""
+    if kinds and kinds <= {bool}:
+        return 'BOOLEAN'
+    if kinds and kinds <= {int}:
+        return 'BIGINT'
+    if kinds and kinds <= {int, float, Decimal}:
+        return 'DOUBLE'
+    return 'VARCHAR'
+
+
+def _export_table(source: Any, duckdb_connection: Any, table: str, directory: Path) -> int:
+    """Streams `table` from the `source` engine into `directory`/`table`.parquet. Returns the number of rows."""
+    from sqlalchemy import text
+
+    csv_path = directory / f'{table}.csv'
+    rows = 0
+    with source.connect() as connection, open(csv_path, 'w', newline='') as file:
+        result = connection.execution_options(yield_per=SNAPSHOT_FETCH_SIZE).execute(text(f'SELECT * FROM {table}'))
+        columns = list(result.keys())
+        kinds: list[set[type]] = [set() for _ in columns]
+        writer = csv.writer(file)
+        for row in result:
+            writer.writerow([__NULL if value is None else value for value in row])
+            for index, value in enumerate(row):
+                if value is not None:
+                    kinds[index].add(type(value))
+            rows += 1
+
+    types = {column: _column_type(kind) for column, kind in zip(columns, kinds)}
+    duckdb_connection.execute(
+        f"COPY (SELECT * FROM read_csv(?, header = false, nullstr = ?, columns = {_struct(types)})) "
+        f"TO '{directory / f'{table}.parquet'}' (FORMAT PARQUET, COMPRESSION ZSTD)",
+        [str(csv_path), __NULL]
+    )
+    csv_path.unlink()
+    return rows
+
+
+def _struct(types: dict[str, str]) -> str:
+    return '{' + ', '.join(f"'{column}': '{type}'" for column, type in types.items()) + '}'
+
+
+def export_snapshot(path: Path = SNAPSHOT_PATH, source: Optional[Any] = None) -> dict[str, int]:
+    """Exports the PIRLS tables from `source` (default: the Postgres database) to Parquet files in `path`, replacing
+    the snapshot there once all tables are written. Returns the rows per table."""
+    import duckdb
+    from src.static.util import create_database_engine
+
+    owned = source is None
+    source = source or create_database_engine()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    directory = Path(tempfile.mkdtemp(prefix=f'{path.name}.', dir=path.parent))
+    try:
+        counts = {}
+        with duckdb.connect() as duckdb_connection:
+            for table in SNAPSHOT_TABLES:
+                start = time.time()
+                counts[table] = _export_table(source, duckdb_connection, table, directory)
+                logging.info(f'Exported {counts[table]} rows of {table} in {time.time() - start:.1f}s')
+        (directory / MANIFEST).write_text(json.dumps({'tables': counts, 'exported_at': time.time()}))
+
+        # the previous snapshot is only removed once the new one is in place
+        previous = path.with_name(f'{path.name}.previous')
+        shutil.rmtree(previous, ignore_errors=True)
+        if path.exists():
+            path.rename(previous)
+        directory.rename(path)
+        shutil.rmtree(previous, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    finally:
+        if owned:
+            source.dispose()
+    return counts
+
+
+def read_manifest(path: Path = SNAPSHOT_PATH) -> Optional[dict]:
+    try:
+        return json.loads((path / MANIFEST).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def _create_catalog(path: Path) -> Path:
+    """A DuckDB database of this process with a view per snapshot table, the connections of the engine open it
+    read-only, so agent queries cannot change or drop the views."""
+    import duckdb
+
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise RuntimeError(f'No PIRLS snapshot in {path}, export one with `python -m src.static.snapshot`')
+    catalog = Path(tempfile.mkdtemp(prefix='pirls_catalog.')) / 'catalog.duckdb'
+    atexit.register(shutil.rmtree, catalog.parent, True)
+    with duckdb.connect(str(catalog)) as connection:
+        for table in manifest['tables']:
+            parquet = (path / f'{table}.parquet').resolve()
+            connection.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{parquet}')")
+    return catalog
+
+
+def create_snapshot_engine(path: Path = SNAPSHOT_PATH) -> Any:
+    """SQLAlchemy engine running the queries on the snapshot in `path` with DuckDB."""
+    import sqlalchemy
+    from src.static.db_pool import InstrumentedQueuePool
+
+    config: dict[str, Any] = {}
+    if DUCKDB_THREADS:
+        config['threads'] = DUCKDB_THREADS
+    if DUCKDB_MEMORY_LIMIT:
+        config['memory_limit'] = DUCKDB_MEMORY_LIMIT
+    engine = sqlalchemy.create_engine(
+        f'duckdb:///{_create_catalog(path)}',
+        poolclass=InstrumentedQueuePool,
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        connect_args={'read_only': True, 'config': config}
+    )
+    snapshot_directory = str(path.resolve()) + os.sep
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def restrict_file_access(dbapi_connection: Any, _: Any) -> None:
+        # agent SQL may only read the snapshot, not other files (read_csv('/etc/passwd'), COPY ... TO, ATTACH).
+        # The settings belong to the database, the connections opened while it is open share them.
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SELECT current_setting('lock_configuration')")
+        if not cursor.fetchone()[0]:
+            cursor.execute(f"SET allowed_directories = ['{snapshot_directory}']")
+            cursor.execute('SET enable_external_access = false')
+            cursor.execute('SET lock_configuration = true')
+        cursor.close()
+
+    return engine
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Exports the PIRLS tables to a local Parquet snapshot.')
+    parser.add_argument('--path', type=Path, default=SNAPSHOT_PATH)
+    args = parser.parse_args()
+    start = time.time()
+    counts = export_snapshot(args.path)
+    logging.info(f'Snapshot of {sum(counts.values())} rows written to {args.path} in {time.time() - start:.1f}s')
@@ -0,0 +1,158 @@
+"""Pre-execution guard for the SQL the agents write.
+
+Before an agent query runs on Postgres, `guard_query` asks the planner for its estimate (`EXPLAIN`, nothing is
+executed). A query expected to return more rows than the tool reads gets a `LIMIT`, so the planner can stop early. A
+query that is still estimated above `SQL_GUARD_MAX_COST` is rejected with `QueryRejected`. Its message tells the agent
+what to change: a join without a join condition and the key to join on, or a full scan of a large table to filter.
+"""
+import json
+import os
+import re
+from typing import Any, Iterator
+
+import dotenv
+from sqlalchemy import text
+
+from src.static.metrics import SQL_LIMITED, SQL_REJECTED
+from src.static.tracing import Span
+
+dotenv.load_dotenv()
+
+SQL_GUARD = os.environ.get('SQL_GUARD', 'true').lower() in ('1', 'true', 'yes')
+# Postgres planner cost units, about one per page read sequentially. A full scan of the largest PIRLS table
+# stays well below it, a cartesian join of two of them does not.
+SQL_GUARD_MAX_COST = float(os.environ.get('SQL_GUARD_MAX_COST', 5_000_000))
+# Scans of more rows than this without a filter are pointed out in the rejection message
+SQL_GUARD_LARGE_SCAN_ROWS = int(os.environ.get('SQL_GUARD_LARGE_SCAN_ROWS', 1_000_000))
+
+# (table, table) -> column they are joined on, from the schema the agents are given
+JOIN_KEYS: dict[frozenset[str], str] = {
+    frozenset(tables): column for *tables, column in (
+        ('Countries', 'Students', 'Country_ID'),
+        ('Countries', 'Schools', 'Country_ID'),
+        ('Countries', 'Curricula', 'Country_ID'),
+        ('Schools', 'Students', 'School_ID'),
+        ('Schools', 'Teachers', 'School_ID'),
+        ('Homes', 'Students', 'Home_ID'),
+        ('Students', 'StudentTeachers', 'Student_ID'),
+        ('Teachers', 'StudentTeachers', 'Teacher_ID'),
+        ('Students', 'StudentScoreResults', 'Student_ID'),
+        ('StudentScoreEntries', 'StudentScoreResults', 'Code'),
+        ('Students', 'StudentQuestionnaireAnswers', 'Student_ID'),
+        ('StudentQuestionnaireEntries', 'StudentQuestionnaireAnswers', 'Code'),
+        ('Students', 'HomeQuestionnaireAnswers', 'Home_ID'),
+        ('Homes', 'HomeQuestionnaireAnswers', 'Home_ID'),
+        ('HomeQuestionnaireEntries', 'HomeQuestionnaireAnswers', 'Code'),
+        ('Schools', 'SchoolQuestionnaireAnswers', 'School_ID'),
+        ('SchoolQuestionnaireEntries', 'SchoolQuestionnaireAnswers', 'Code'),
+        ('Teachers', 'TeacherQuestionnaireAnswers', 'Teacher_ID'),
+        ('TeacherQuestionnaireEntries', 'TeacherQuestionnaireAnswers', 'Code'),
+        ('Curricula', 'CurriculumQuestionnaireAnswers', 'Curriculum_ID'),
+        ('CurriculumQuestionnaireEntries', 'CurriculumQuestionnaireAnswers', 'Code'),
+    )
+}
+# Postgres reports the folded (lower-case) names of unquoted identifiers
+TABLE_NAMES = {table.lower(): table for tables in JOIN_KEYS for table in tables}
+
+__LEADING_COMMENTS = re.compile(r'^(?:\s+|--[^\n]*|/\*.*?\*/)*', re.DOTALL)
+__TRAILING_SEMICOLONS = re.compile(r'[\s;]*$')
+
+
+class QueryRejected(Exception):
+    """The planner estimates the query too expensive to run, the message says why and what to change."""
+
+
+def _first_word(query: str) -> str:
+    match = re.match(r'[A-Za-z]+', __LEADING_COMMENTS.sub('', query, count=1))
+    return match.group().lower() if match else ''
+
+
+def _plan(connection: Any, query: str) -> dict[str, Any]:
+    plan = connection.execute(text(f'EXPLAIN (FORMAT JSON) {query}')).scalar()
+    # psycopg2 parses json columns, other drivers return the text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def _nodes(node: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    yield node
+    for child in node.get('Plans', []):
+        yield from _nodes(child)
+
+
+def _relations(node: dict[str, Any]) -> list[str]:
+    names = []
+    for child in _nodes(node):
+        name = child.get('Relation Name')
+        if name is not None:
+            names.append(TABLE_NAMES.get(name.lower(), name))
+    return names
+
+
+def _has_condition(node: dict[str, Any]) -> bool:
+    """Whether a join node, or an index scan of its inner side, restricts the pairs of rows it produces."""
+    if any(key in node for key in ('Join Filter', 'Hash Cond', 'Merge Cond')):
+        return True
+    # a parameterized nested loop restricts the inner side by the outer row
+    return any('Index Cond' in child or 'Recheck Cond' in child for child in _nodes(node) if child is not node)
+
+
+def plan_hints(plan: dict[str, Any]) -> list[tuple[str, str]]:
+    """What makes a plan expensive, as (reason, hint): joins without a join condition ('cartesian_join') and full
+    scans of large tables ('full_scan')."""
+    hints = []
+    for node in _nodes(plan):
+        if node.get('Node Type') == 'Nested Loop' and not _has_condition(node) and len(node.get('Plans', [])) == 2:
+            outer, inner = (_relations(child) for child in node['Plans'])
+            hint = f'{", ".join(outer) or "a subquery"} and {", ".join(inner) or "a subquery"} are joined without a ' \
+                   f'join condition (every row with every row)'
+            keys = [
+                f'{left}.{JOIN_KEYS[frozenset((left, right))]} = {right}.{JOIN_KEYS[frozenset((left, right))]}'
+                for left in outer for right in inner if frozenset((left, right)) in JOIN_KEYS
+            ]
+            hints.append(('cartesian_join', hint + (f', join them ON {" AND ".join(keys)}' if keys else '')))
+        elif node.get('Node Type') == 'Seq Scan' and 'Filter' not in node \
+                and node.get('Plan Rows', 0) >= SQL_GUARD_LARGE_SCAN_ROWS:
+            table = TABLE_NAMES.get(node.get('Relation Name', '').lower(), node.get('Relation Name'))
+            hints.append((
+                'full_scan', f'{table} is read in full (~{node["Plan Rows"]:,} rows), filter it, e.g. on Code or by country'
+            ))
+    return hints
+
+
+def _limited(query: str, limit: int) -> str:
+    # the query stays a subquery, its own ORDER BY, LIMIT or set operations keep their meaning
+    return f'SELECT * FROM (\n{__TRAILING_SEMICOLONS.sub("", query)}\n) AS limited LIMIT {limit}'
+
+
+def guard_query(connection: Any, query: str, max_rows: int, current: Span) -> str:
+    """Returns the query to execute on `connection` in place of `query`, with a `LIMIT` of `max_rows` + 1 when the
+    planner expects more rows than `max_rows`, or raises `QueryRejected`. Only read queries on Postgres are checked,
+    the estimates are recorded on the span `current`."""
+    if not SQL_GUARD or connection.dialect.name != 'postgresql' \
+            or _first_word(query) not in ('select', 'with', 'values', 'table'):
+        return query
+
+    plan = _plan(connection, query)
+    if plan.get('Plan Rows', 0) > max_rows:
+        # one more row than the tool reads, so it still reports that rows were omitted
+        query = _limited(query, max_rows + 1)
+        plan = _plan(connection, query)
+        SQL_LIMITED.inc()
+        current.set(**{'db.guard': 'limited'})
+
+    cost = plan.get('Total Cost', 0.0)
+    current.set(**{'db.plan_cost': cost, 'db.plan_rows': plan.get('Plan Rows', 0)})
+    if cost <= SQL_GUARD_MAX_COST:
+        return query
+
+    hints = plan_hints(plan)
+    SQL_REJECTED.inc(reason=hints[0][0] if hints else 'cost')
+    current.set(**{'db.guard': 'rejected'})
+    message = f'The query was not run, its estimated cost {cost:,.0f} is above the limit of {SQL_GUARD_MAX_COST:,.0f}.'
+    if hints:
+        message += ' ' + '; '.join(hint[0].upper() + hint[1:] for _, hint in hints) + '.'
+    else:
+        message += ' Filter the rows earlier or query fewer tables.'
+    raise QueryRejected(message)
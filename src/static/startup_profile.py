@@ -0,0 +1,84 @@
+"""Import-time profile of the service.
+
+    python -m src.static.startup_profile [--module src.static.app] [--top 20] [--budget 1.5]
+
+Imports the module in a fresh interpreter with `-X importtime`, prints the wall time and the modules with the highest
+cumulative import time, and exits with 1 if the import took longer than `--budget` seconds.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import NamedTuple
+
+from src.static.util import PROJECT_ROOT
+
+# Modules the service must not import at startup, they are loaded with the submission or the first query
+DEFERRED_MODULES = ('crewai', 'langchain_aws', 'langchain_community', 'sqlalchemy', 'psycopg2', 'duckdb', 'boto3')
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+class StartupProfile(NamedTuple):
+    wall_time: float
+    imports: list[ImportTime]
+    loaded_deferred: list[str]
+
+
+__SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print('loaded:' + ','.join(sorted(name for name in {deferred!r} if name in sys.modules)))
+'''
+
+
+def profile_startup(module: str = 'src.static.app') -> StartupProfile:
+    """Imports `module` in a fresh interpreter, the way a new replica does."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', __SCRIPT.format(module=module, deferred=DEFERRED_MODULES)],
+        cwd=PROJECT_ROOT.parent,
+        env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'},
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    wall_time, loaded = result.stdout.strip().split('\n')[-2:]
+    loaded = loaded[len('loaded:'):]
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time:      self [us] |    cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append(ImportTime(name.strip(), int(self_us), int(cumulative_us)))
+    return StartupProfile(float(wall_time), imports, [name for name in loaded.split(',') if name])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='src.static.app')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=None, help='maximum import time in seconds')
+    args = parser.parse_args()
+
+    profile = profile_startup(args.module)
+    print(f'import {args.module}: {profile.wall_time:.3f}s')
+    print(f'{"cumulative [ms]":>16} {"self [ms]":>10}  module')
+    for entry in sorted(profile.imports, key=lambda entry: entry.cumulative_us, reverse=True)[:args.top]:
+        print(f'{entry.cumulative_us / 1000:16.1f} {entry.self_us / 1000:10.1f}  {entry.module}')
+    if profile.loaded_deferred:
+        print(f'imported at startup although deferred: {", ".join(profile.loaded_deferred)}')
+
+    if args.budget is not None and profile.wall_time > args.budget:
+        print(f'startup budget of {args.budget:.3f}s exceeded')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,32 @@
+import asyncio
 from abc import ABC, abstractmethod
+from typing import Optional
+
+from src.static.call_context import bind_call
+from src.static.metrics import RUNS_IN_FLIGHT
 
 
 class Submission(ABC):
     @abstractmethod
     def run(self, prompt: str) -> str:
         ...
+
+    def prepare(self) -> None:
+        """Builds what `run` needs ahead of the first run, e.g. when the submission is pooled."""
+        pass
+
+    async def arun(self, prompt: str, call_id: Optional[str] = None) -> str:
+        """Runs the submission without blocking the event loop.
+
+        The default implementation runs `run` in a worker thread with `call_id` set as the current call, so the
+        Bedrock requests and database queries of the call stop once it is cancelled (see `call_context.cancel_call`).
+        Cancelling the awaiting task alone cannot stop the thread.
+        """
+        with bind_call(call_id):
+            # `to_thread` copies the context, including the current call
+            return await asyncio.to_thread(self.__run_in_flight, prompt)
+
+    def __run_in_flight(self, prompt: str) -> str:
+        # counted until the thread is done, which may be long after a timed out request returned
+        with RUNS_IN_FLIGHT.track():
+            return self.run(prompt)
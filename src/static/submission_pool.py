@@ -0,0 +1,114 @@
+import os
+import threading
+from typing import Callable, Optional
+
+import dotenv
+
+from src.static.submission import Submission
+
+dotenv.load_dotenv()
+
+SUBMISSION_POOL_SIZE = int(os.environ.get('SUBMISSION_POOL_SIZE', 8))
+SUBMISSION_POOL_WARM_UP = int(os.environ.get('SUBMISSION_POOL_WARM_UP', 1))
+
+
+def bind_llm_call_id(submission: Submission, call_id: str) -> None:
+    submission.llm.call_id = call_id
+
+
+class SubmissionPool:
+    """Pool of pre-built submissions (crews with their agents, tasks and LLM), so a request does not pay for building
+    them. A submission is used by one run at a time and only the call id of its accounting is swapped in.
+
+    At most `max_idle` submissions are kept, more are built when all of them are busy.
+    """
+
+    def __init__(
+            self,
+            factory: Callable[[], Submission],
+            bind: Callable[[Submission, str], None] = bind_llm_call_id,
+            max_idle: int = SUBMISSION_POOL_SIZE
+    ):
+        self.factory = factory
+        self.bind = bind
+        self.max_idle = max_idle
+        self.built = 0
+        self.reused = 0
+        self.prototype: Optional[Submission] = None
+        self.__idle: list[Submission] = []
+        self.__lock = threading.Lock()
+        _POOLS.append(self)
+
+    def __build(self) -> Submission:
+        submission = self.factory()
+        submission.prepare()
+        with self.__lock:
+            self.built += 1
+            if self.prototype is None:
+                self.prototype = submission
+        return submission
+
+    def acquire(self, call_id: str) -> Submission:
+        with self.__lock:
+            submission = self.__idle.pop() if self.__idle else None
+            self.reused += submission is not None
+        if submission is None:
+            submission = self.__build()
+        self.bind(submission, call_id)
+        return submission
+
+    def release(self, submission: Submission) -> None:
+        self.bind(submission, '')
+        with self.__lock:
+            if len(self.__idle) < self.max_idle:
+                self.__idle.append(submission)
+
+    def warm_up(self, size: int = SUBMISSION_POOL_WARM_UP) -> None:
+        with self.__lock:
+            missing = min(size, self.max_idle) - len(self.__idle)
+        for submission in [self.__build() for _ in range(missing)]:
+            self.release(submission)
+
+    def template(self) -> Submission:
+        """A submission of the pool, possibly in use, to inspect its configuration."""
+        if self.prototype is None:
+            self.release(self.__build())
+        return self.prototype
+
+    def submission(self, call_id: str) -> 'PooledSubmission':
+        return PooledSubmission(self, call_id)
+
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {'idle': len(self.__idle), 'max_idle': self.max_idle, 'built': self.built, 'reused': self.reused}
+
+
+class PooledSubmission(Submission):
+    """Submission of a single call, running on a submission taken from the pool for the duration of `run`.
+
+    The pooled submission is taken and returned by the thread executing `run`, so one that is still in use by a call
+    whose request already timed out is not handed to another call.
+    """
+
+    def __init__(self, pool: SubmissionPool, call_id: str):
+        self.pool = pool
+        self.call_id = call_id
+
+    def run(self, prompt: str) -> str:
+        submission = self.pool.acquire(self.call_id)
+        try:
+            return submission.run(prompt)
+        finally:
+            self.pool.release(submission)
+
+
+_POOLS: list[SubmissionPool] = []
+
+
+def warm_up_pools() -> None:
+    for pool in _POOLS:
+        pool.warm_up()
+
+
+def submission_pool_stats() -> list[dict[str, int]]:
+    return [pool.stats() for pool in _POOLS]
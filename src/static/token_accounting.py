@@ -0,0 +1,190 @@
+import logging
+import threading
+
+# Mapping of model names to their respective costs per 1,000 tokens (input and output)
+COST_MAPPING: dict[str, dict[str, float]] = {
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': {'input': 0.003, 'output': 0.015},
+    'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125},
+    'amazon.titan-text-premier-v1:0': {'input': 0.0005, 'output': 0.0015},
+    'meta.llama3-8b-instruct-v1:0': {'input': 0.0003, 'output': 0.0006},
+    'meta.llama3-70b-instruct-v1:0': {'input': 0.00265, 'output': 0.0035},
+    'mistral.mistral-7b-instruct-v0:2': {'input': 0.00015, 'output': 0.0002},
+    'mistral.mixtral-8x7b-instruct-v0:1': {'input': 0.00045, 'output': 0.0007}
+}
+
+# Precomputed cost of a single token, so the streaming path only does a lookup and a multiplication
+_PRICE_PER_TOKEN: dict[str, dict[str, float]] = {
+    model_id: {mode: cost / 1000 for mode, cost in costs.items()}
+    for model_id, costs in COST_MAPPING.items()
+}
+
+
+class ModelUsage:
+    __slots__ = (
+        'total_tokens', 'prompt_tokens', 'completion_tokens', 'successful_requests', 'estimated_requests', 'total_cost'
+    )
+
+    def __init__(self):
+        self.total_tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.successful_requests = 0
+        # requests whose usage was counted locally because Bedrock did not report it (or in 'estimated' mode)
+        self.estimated_requests = 0
+        self.total_cost = 0.0
+
+    def __getitem__(self, item: str) -> int | float:
+        return getattr(self, item)
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+class UsageReconciliation:
+    """Reported vs locally estimated tokens of the requests where both were known ('reconcile' mode)."""
+    __slots__ = (
+        'requests', 'reported_prompt_tokens', 'reported_completion_tokens',
+        'estimated_prompt_tokens', 'estimated_completion_tokens'
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.reported_prompt_tokens = 0
+        self.reported_completion_tokens = 0
+        self.estimated_prompt_tokens = 0
+        self.estimated_completion_tokens = 0
+
+    def as_dict(self) -> dict[str, int | float]:
+        ret = {attr: getattr(self, attr) for attr in self.__slots__}
+        reported = self.reported_prompt_tokens + self.reported_completion_tokens
+        estimated = self.estimated_prompt_tokens + self.estimated_completion_tokens
+        ret['relative_error'] = (estimated - reported) / reported if reported else 0.0
+        return ret
+
+
+class CallAccounting:
+    """Token usage and cost of a single call (`call_id`), per model.
+
+    Every update happens under the accounting's own lock, so threads working on different calls never contend and
+    threads of the same call cannot lose increments.
+    """
+    __slots__ = ('call_id', 'models', 'reconciliation', '_lock')
+
+    def __init__(self, call_id: str):
+        self.call_id = call_id
+        self.models: dict[str, ModelUsage] = {}
+        self.reconciliation: dict[str, UsageReconciliation] = {}
+        self._lock = threading.Lock()
+
+    def add_usage(self, model_id: str, prompt_tokens: int, completion_tokens: int, estimated: bool = False) -> None:
+        """Accounts a single request."""
+        prices = _PRICE_PER_TOKEN[model_id]
+        cost = prompt_tokens * prices['input'] + completion_tokens * prices['output']
+        with self._lock:
+            usage = self.models.setdefault(model_id, ModelUsage())
+            usage.total_tokens += prompt_tokens + completion_tokens
+            usage.prompt_tokens += prompt_tokens
+            usage.completion_tokens += completion_tokens
+            usage.successful_requests += 1
+            usage.estimated_requests += estimated
+            usage.total_cost += cost
+
+    def add_reconciliation(
+            self,
+            model_id: str,
+            reported_prompt_tokens: int,
+            reported_completion_tokens: int,
+            estimated_prompt_tokens: int,
+            estimated_completion_tokens: int
+    ) -> None:
+        with self._lock:
+            reconciliation = self.reconciliation.setdefault(model_id, UsageReconciliation())
+            reconciliation.requests += 1
+            reconciliation.reported_prompt_tokens += reported_prompt_tokens
+            reconciliation.reported_completion_tokens += reported_completion_tokens
+            reconciliation.estimated_prompt_tokens += estimated_prompt_tokens
+            reconciliation.estimated_completion_tokens += estimated_completion_tokens
+
+    def total_tokens(self) -> int:
+        with self._lock:
+            return sum(usage.total_tokens for usage in self.models.values())
+
+    def total_cost(self) -> float:
+        with self._lock:
+            return sum(usage.total_cost for usage in self.models.values())
+
+    def token_details(self) -> dict:
+        with self._lock:
+            return {
+                model_id: {
+                    'prompt_tokens': usage.prompt_tokens,
+                    'completion_tokens': usage.completion_tokens
+                }
+                for model_id, usage in self.models.items()
+            }
+
+    def reconciliation_report(self) -> dict:
+        with self._lock:
+            return {model_id: reconciliation.as_dict() for model_id, reconciliation in self.reconciliation.items()}
+
+    def __getitem__(self, model_id: str) -> ModelUsage:
+        return self.models[model_id]
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self.models
+
+    def values(self):
+        return self.models.values()
+
+
+# Accounting of the calls in progress, registered by whoever owns the call (see app.py). Updates for call ids that
+# are not (or no longer) registered, e.g. from a thread still running after its request timed out, are dropped.
+TOKEN_COUNTER: dict[str, CallAccounting] = {}
+
+_NO_USAGE = CallAccounting('')
+
+
+def get_total_number_of_tokens(call_id: str) -> int:
+    return TOKEN_COUNTER.get(call_id, _NO_USAGE).total_tokens()
+
+
+def get_total_cost(call_id: str) -> float:
+    return TOKEN_COUNTER.get(call_id, _NO_USAGE).total_cost()
+
+
+def get_token_details(call_id: str) -> dict:
+    return TOKEN_COUNTER.get(call_id, _NO_USAGE).token_details()
+
+
+def get_token_reconciliation(call_id: str) -> dict:
+    return TOKEN_COUNTER.get(call_id, _NO_USAGE).reconciliation_report()
+
+
+def get_token_cost(tokens: int, model_id: str, mode: str) -> float:
+    assert mode in ['prompt', 'completion', 'input', 'output'], f'mode "{mode}" is not supported'
+    if mode == 'prompt':
+        mode = 'input'
+    elif mode == 'completion':
+        mode = 'output'
+    return tokens * _PRICE_PER_TOKEN[model_id][mode]
+
+
+def compute_llm_call_cost(model_id: str, call_id: str) -> float:
+    logging.info(f"Starting cost computation for model: {model_id}, call ID: {call_id}")
+
+    token_counts = TOKEN_COUNTER[str(call_id)][model_id]
+    prompt_tokens = token_counts['prompt_tokens']
+    completion_tokens = token_counts['completion_tokens']
+
+    logging.info(f"Token counts - Prompt: {prompt_tokens}, Completion: {completion_tokens}")
+
+    input_cost = (prompt_tokens / 1000) * COST_MAPPING[model_id]['input']
+    output_cost = (completion_tokens / 1000) * COST_MAPPING[model_id]['output']
+
+    logging.info(f"Input cost: ${input_cost}, Output cost: ${output_cost}")
+
+    total_cost = input_cost + output_cost
+
+    logging.info(f"Total cost for call ID {call_id}: ${total_cost}")
+
+    return total_cost
@@ -0,0 +1,223 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import dotenv
+
+from src.static.call_context import current_call_id
+
+dotenv.load_dotenv()
+
+# Spans of every traced call are appended to this JSONL file, one OpenTelemetry (OTLP/JSON) span per line. Setting
+# it traces every request, otherwise only requests asking for their trace are traced.
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH') or None
+# Longest string attribute kept, e.g. SQL statements and agent output
+TRACE_MAX_ATTRIBUTE_LENGTH = int(os.environ.get('TRACE_MAX_ATTRIBUTE_LENGTH', 2_000))
+
+
+class Span:
+    __slots__ = ('name', 'kind', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, name: str, kind: str, parent_id: Optional[str], attributes: dict[str, Any]):
+        self.name = name
+        self.kind = kind
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+        self.attributes = {}
+        self.error: Optional[str] = None
+        self.set(**attributes)
+
+    def set(self, **attributes: Any) -> None:
+        for key, value in attributes.items():
+            if isinstance(value, str) and len(value) > TRACE_MAX_ATTRIBUTE_LENGTH:
+                value = value[:TRACE_MAX_ATTRIBUTE_LENGTH] + '...'
+            self.attributes[key] = value
+
+    def elapsed(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start / 1e9,
+            'duration': self.elapsed(),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+    def as_otlp(self, trace_id: str) -> dict[str, Any]:
+        def value(v: Any) -> dict[str, Any]:
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': str(v)}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': str(v)}
+
+        return {
+            'traceId': trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': {'llm': 3, 'tool': 1, 'db': 3}.get(self.kind, 1),  # SPAN_KIND_CLIENT / SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end or self.start),
+            'attributes': [{'key': k, 'value': value(v)} for k, v in {'span.kind': self.kind, **self.attributes}.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1}
+        }
+
+
+class _NoSpan:
+    """Stands in for a span when the call is not traced, so instrumented code does not need to check."""
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """Spans of a single call, in the order they ended."""
+
+    def __init__(self, call_id: str):
+        self.call_id = call_id
+        self.trace_id = uuid.uuid4().hex
+        self.spans: list[Span] = []
+        # crewai only reports the end of a task, a task starts where the previous one (or its crew's kickoff) ended
+        self.last_task_end = time.time_ns()
+        self.__lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self.__lock:
+            self.spans.append(span)
+
+    def report(self) -> list[dict[str, Any]]:
+        with self.__lock:
+            return [span.as_dict() for span in self.spans]
+
+    def export(self, path: str) -> None:
+        with self.__lock:
+            lines = [json.dumps(span.as_otlp(self.trace_id)) + '\n' for span in self.spans]
+        with _EXPORT_LOCK:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'a') as file:
+                file.writelines(lines)
+
+
+# Traces of the traced calls in progress, registered by whoever owns the call (see app.py)
+TRACES: dict[str, Trace] = {}
+
+_CURRENT_SPAN: ContextVar[Optional[Span]] = ContextVar('_CURRENT_SPAN', default=None)
+_EXPORT_LOCK = threading.Lock()
+
+
+def start_trace(call_id: str) -> Trace:
+    trace = TRACES[call_id] = Trace(call_id)
+    return trace
+
+
+def end_trace(call_id: str) -> Optional[Trace]:
+    """Stops tracing the call and exports its spans to `TRACE_EXPORT_PATH`, if set."""
+    trace = TRACES.pop(call_id, None)
+    if trace is not None and TRACE_EXPORT_PATH:
+        trace.export(TRACE_EXPORT_PATH)
+    return trace
+
+
+def get_trace_report(call_id: str) -> list[dict[str, Any]]:
+    trace = TRACES.get(call_id)
+    return trace.report() if trace is not None else []
+
+
+def start_span(name: str, kind: str = 'internal', call_id: Optional[str] = None, **attributes: Any) -> Span | _NoSpan:
+    """Starts a span that is not made the current span, for work that outlives a `with` block (e.g. a stream). Must
+    be ended with `end_span`."""
+    if not TRACES:
+        return _NO_SPAN
+    trace = TRACES.get(call_id or current_call_id())
+    if trace is None:
+        return _NO_SPAN
+    parent = _CURRENT_SPAN.get()
+    return Span(name, kind, parent.span_id if parent is not None else None, attributes)
+
+
+def end_span(span: Span | _NoSpan, call_id: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+    if isinstance(span, _NoSpan):
+        return
+    span.end = time.time_ns()
+    if error is not None:
+        span.error = repr(error)
+    trace = TRACES.get(call_id or current_call_id())
+    if trace is not None:
+        trace.add(span)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = 'internal', call_id: Optional[str] = None, **attributes: Any) -> Iterator[Span | _NoSpan]:
+    """Traces the body as a child of the current span, if the call (`call_id` or the current call) is traced."""
+    current = start_span(name, kind, call_id, **attributes)
+    if isinstance(current, _NoSpan):
+        yield current
+        return
+    token = _CURRENT_SPAN.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        end_span(current, call_id, error)
+
+
+def record_task(output: Any) -> None:
+    """crewai `task_callback`: records the task that just ended, starting where the previous one or the current span
+    (the kickoff) started."""
+    trace = TRACES.get(current_call_id())
+    if trace is None:
+        return
+    parent = _CURRENT_SPAN.get()
+    task = Span('crew.task', 'internal', parent.span_id if parent is not None else None, {
+        'task.description': str(getattr(output, 'description', '')),
+        'task.agent': str(getattr(output, 'agent', '')),
+        'task.output': str(getattr(output, 'raw', output))
+    })
+    task.start, task.end = max(trace.last_task_end, parent.start if parent is not None else 0), time.time_ns()
+    trace.last_task_end = task.end
+    trace.add(task)
+
+
+def record_step(step: Any) -> None:
+    """crewai `step_callback`: records an agent step (tool calls with their observations, or the final answer) as an
+    event span."""
+    trace = TRACES.get(current_call_id())
+    if trace is None:
+        return
+    parent = _CURRENT_SPAN.get()
+    attributes = {}
+    if isinstance(step, list):
+        for index, (action, observation) in enumerate(step):
+            attributes[f'agent.tool.{index}'] = str(getattr(action, 'tool', ''))
+            attributes[f'agent.tool_input.{index}'] = str(getattr(action, 'tool_input', ''))
+            attributes[f'agent.observation.{index}'] = str(observation)
+            attributes['agent.thought'] = str(getattr(action, 'log', ''))
+    else:
+        attributes['agent.output'] = str(getattr(step, 'return_values', step))
+        attributes['agent.thought'] = str(getattr(step, 'log', ''))
+    event = Span('agent.step', 'event', parent.span_id if parent is not None else None, attributes)
+    event.end = event.start
+    trace.add(event)
@@ -1,23 +1,103 @@
 import os
+import threading
 from pathlib import Path
+from typing import Optional
 
 import dotenv
-import sqlalchemy
-from crewai.telemetry import Telemetry
 
 dotenv.load_dotenv()
 
-__db_url = f'postgresql://{os.environ["DB_USER"]}:{os.environ["DB_PASSWORD"]}@{os.environ["DB_ENDPOINT"]}:{os.environ["DB_PORT"]}/postgres'
-ENGINE = sqlalchemy.create_engine(__db_url)
-
 PROJECT_ROOT = Path(__file__).parent.parent
 
 
-# Disable CrewAI Telemetry
+def __env_bool(name: str, default: bool) -> bool:
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+# 'postgres': the PIRLS database, 'duckdb': the local Parquet snapshot
+DB_BACKEND = os.environ.get('DB_BACKEND', 'postgres').lower()
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def create_database_engine():
+    """A new SQLAlchemy engine of the PIRLS database. `DB_URL` overrides the Postgres URL built from `DB_USER`,
+    `DB_PASSWORD`, `DB_ENDPOINT` and `DB_PORT`."""
+    import sqlalchemy
+    from src.static.db_pool import InstrumentedQueuePool
+
+    db_url = os.environ.get('DB_URL') or (
+        f'postgresql://{os.environ["DB_USER"]}:{os.environ["DB_PASSWORD"]}'
+        f'@{os.environ["DB_ENDPOINT"]}:{os.environ["DB_PORT"]}/postgres'
+    )
+    # a tool query is expected to take seconds, 0 disables the timeout
+    statement_timeout_ms = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30_000))
+    return sqlalchemy.create_engine(
+        db_url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', -1)),
+        pool_pre_ping=__env_bool('DB_POOL_PRE_PING', False),
+        connect_args={'options': f'-c statement_timeout={statement_timeout_ms}'} if statement_timeout_ms else {}
+    )
+
+
+def get_engine():
+    """The SQLAlchemy engine the PIRLS data is queried with, created on first use so that importing the service stays
+    cheap (no sqlalchemy / psycopg2 import, no pool) until a query is made. `DB_BACKEND=duckdb` queries the local
+    snapshot of src/static/snapshot.py instead of the database."""
+    global _ENGINE
+    if _ENGINE is not None:
+        return _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            if DB_BACKEND == 'duckdb':
+                from src.static.snapshot import create_snapshot_engine
+                _ENGINE = create_snapshot_engine()
+            else:
+                _ENGINE = create_database_engine()
+    return _ENGINE
+
+
+def __getattr__(name: str):
+    # `from src.static.util import ENGINE` keeps working, it creates the engine at that point
+    if name == 'ENGINE':
+        return get_engine()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def warm_up_engine(connections: Optional[int] = None) -> None:
+    """Opens `connections` (default: `DB_POOL_WARM_UP` or the pool size) connections at once and returns them to the
+    pool, so the first requests skip the connection handshake."""
+    engine = get_engine()
+    if connections is None:
+        connections = int(os.environ.get('DB_POOL_WARM_UP', engine.pool.size()))
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(engine.raw_connection())
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+def pool_stats() -> dict[str, int | float]:
+    # no engine yet, nothing to report
+    return _ENGINE.pool.stats() if _ENGINE is not None else {}
+
+
 def noop(*args, **kwargs):
     pass
 
 
-for attr in dir(Telemetry):
-    if callable(getattr(Telemetry, attr)) and not attr.startswith("__"):
-        setattr(Telemetry, attr, noop)
+def disable_crewai_telemetry() -> None:
+    """Disables CrewAI Telemetry. Called by the modules that use crewai, so that importing this module does not
+    import crewai."""
+    from crewai.telemetry import Telemetry
+
+    for attr in dir(Telemetry):
+        if callable(getattr(Telemetry, attr)) and not attr.startswith("__"):
+            setattr(Telemetry, attr, noop)
@@ -2,9 +2,14 @@ from crewai import Agent, Crew, Process, Task
 from crewai.project import CrewBase, agent, crew, task
 
 from src.static.submission import Submission
-from src.static.util import PROJECT_ROOT
+from src.static.run_events import step_callback, task_callback
+from src.static.tracing import span
+from src.static.util import PROJECT_ROOT, disable_crewai_telemetry
+import src.submission.tools.aggregates as aggregate_tools
 import src.submission.tools.database as db_tools
 
+disable_crewai_telemetry()
+
 
 @CrewBase
 class AdvancedPIRLSCrew(Submission):
@@ -15,9 +20,17 @@ class AdvancedPIRLSCrew(Submission):
 
     def __init__(self, llm):
         self.llm = llm
+        self.__crew = None
+
+    def prepare(self) -> None:
+        # the crew is built once and kicked off by every run, kickoff re-interpolates the original task descriptions
+        if self.__crew is None:
+            self.__crew = self.crew()
 
     def run(self, prompt: str) -> str:
-        return self.crew().kickoff(inputs={'user_question': prompt}).raw
+        self.prepare()
+        with span('crew.kickoff', **{'crew.class': type(self).__name__}):
+            return self.__crew.kickoff(inputs={'user_question': prompt}).raw
 
     @agent
     def lead_data_analyst(self) -> Agent:
@@ -37,6 +50,7 @@ class AdvancedPIRLSCrew(Submission):
             allow_delegation=False,
             verbose=True,
             tools=[
+                aggregate_tools.query_aggregates,
                 db_tools.query_database,
                 db_tools.get_possible_answers_to_question,
                 db_tools.get_questions_of_given_type
@@ -59,6 +73,8 @@ class AdvancedPIRLSCrew(Submission):
             agents=self.agents,
             tasks=self.tasks,
             process=Process.sequential,
+            task_callback=task_callback,
+            step_callback=step_callback,
             verbose=True,
             max_iter=5,
             cache=True
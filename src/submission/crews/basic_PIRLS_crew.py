@@ -3,17 +3,31 @@ from crewai.project import agent, crew, task
 from textwrap import dedent
 
 from src.static.submission import Submission
+from src.static.run_events import step_callback, task_callback
+from src.static.tracing import span
 from src.static.ChatBedrockWrapper import ChatBedrockWrapper
+from src.submission.tools.aggregates import query_aggregates
 from src.submission.tools.database import query_database
+from src.static.util import disable_crewai_telemetry
+
+disable_crewai_telemetry()
 
 
 class BasicPIRLSCrew(Submission):
 
     def __init__(self, llm: ChatBedrockWrapper):
         self.llm = llm
+        self.__crew = None
+
+    def prepare(self) -> None:
+        # the crew is built once and kicked off by every run, kickoff re-interpolates the original task descriptions
+        if self.__crew is None:
+            self.__crew = self.crew()
 
     def run(self, prompt: str) -> str:
-        return self.crew().kickoff(inputs={"prompt": prompt}).raw
+        self.prepare()
+        with span('crew.kickoff', **{'crew.class': type(self).__name__}):
+            return self.__crew.kickoff(inputs={"prompt": prompt}).raw
 
     @agent
     def database_expert(self) -> Agent:
@@ -29,7 +43,7 @@ class BasicPIRLSCrew(Submission):
             llm=self.llm,
             allow_delegation=False,
             verbose=True,
-            tools=[query_database]
+            tools=[query_aggregates, query_database]
         )
 
     @task
@@ -46,6 +60,8 @@ class BasicPIRLSCrew(Submission):
             agents=self.agents,
             tasks=self.tasks,
             process=Process.sequential,
+            task_callback=task_callback,
+            step_callback=step_callback,
             verbose=True,
             max_iter=3,
             cache=False
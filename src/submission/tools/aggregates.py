@@ -0,0 +1,219 @@
+import contextlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import dotenv
+from langchain_core.tools import tool
+from sqlalchemy import text
+
+from src.static.call_context import check_cancelled
+from src.static.tracing import span
+from src.static.util import PROJECT_ROOT, get_engine
+from src.submission.tools.formatting import get_formatter, with_query
+
+dotenv.load_dotenv()
+
+# Small local SQLite database with the aggregations most questions reduce to, built from the PIRLS database by
+# `python -m src.submission.tools.aggregates` and queried by the `query_aggregates` tool instead of scanning the
+# score and answer tables.
+AGGREGATES_PATH = Path(os.environ.get('AGGREGATES_PATH', PROJECT_ROOT.parent / '.cache' / 'pirls_aggregates.sqlite'))
+AGGREGATES_MAX_AGE = float(os.environ.get('AGGREGATES_MAX_AGE', 7 * 24 * 3600))
+# Like the questionnaire index, a service process only uses the file unless it is allowed to build it itself
+AGGREGATES_AUTO_BUILD = os.environ.get('AGGREGATES_AUTO_BUILD', 'false').lower() in ('1', 'true', 'yes')
+# Score the benchmark attainment is computed on, the overall reading score
+AGGREGATES_BENCHMARK_CODE = os.environ.get('AGGREGATES_BENCHMARK_CODE', 'ASRREA_avg')
+AGGREGATES_MAX_ROWS = int(os.environ.get('AGGREGATES_MAX_ROWS', 100))
+# Minimum number of seconds between two background builds
+AGGREGATES_REFRESH_INTERVAL = float(os.environ.get('AGGREGATES_REFRESH_INTERVAL', 60))
+
+# questionnaire -> (answers table, joins from the answers (A) to the entity (E) that has the country)
+ANSWER_COUNTRIES: dict[str, tuple[str, str]] = {
+    'Students': ('StudentQuestionnaireAnswers', 'JOIN Students AS E ON E.Student_ID = A.Student_ID'),
+    'Homes': ('HomeQuestionnaireAnswers', 'JOIN Students AS E ON E.Home_ID = A.Home_ID'),
+    'Schools': ('SchoolQuestionnaireAnswers', 'JOIN Schools AS E ON E.School_ID = A.School_ID'),
+    'Teachers': (
+        'TeacherQuestionnaireAnswers',
+        'JOIN Teachers AS T ON T.Teacher_ID = A.Teacher_ID JOIN Schools AS E ON E.School_ID = T.School_ID'
+    ),
+    'Curricula': ('CurriculumQuestionnaireAnswers', 'JOIN Curricula AS E ON E.Curriculum_ID = A.Curriculum_ID'),
+}
+
+SCHEMA = """
+CREATE TABLE CountryScores (
+    Country TEXT, Code TEXT, Students INTEGER, Mean REAL, StdDev REAL, Min REAL, Max REAL,
+    PRIMARY KEY (Country, Code)
+);
+CREATE TABLE BenchmarkAttainment (
+    Country TEXT, Benchmark TEXT, Threshold INTEGER, Students INTEGER, Share REAL,
+    PRIMARY KEY (Country, Benchmark)
+);
+CREATE TABLE AnswerDistribution (
+    Questionnaire TEXT, Country TEXT, Code TEXT, Answer TEXT, Respondents INTEGER, Share REAL
+);
+CREATE INDEX AnswerDistribution_code ON AnswerDistribution (Code, Country);
+CREATE TABLE Metadata (Key TEXT PRIMARY KEY, Value TEXT);
+"""
+
+_BUILD_LOCK = threading.Lock()
+_LAST_REFRESH = 0.0
+
+
+def build_aggregates(path: Path = AGGREGATES_PATH) -> dict[str, int]:
+    """Computes the aggregates on the PIRLS database and replaces the file at `path`. Returns the rows per table."""
+    with get_engine().connect() as connection:
+        scores = []
+        for country, code, students, total, squares, low, high in connection.execute(text("""
+            SELECT C.Name, SSR.Code, COUNT(SSR.Score), SUM(SSR.Score), SUM(SSR.Score * SSR.Score), MIN(SSR.Score), MAX(SSR.Score)
+            FROM StudentScoreResults AS SSR
+            JOIN Students AS S ON S.Student_ID = SSR.Student_ID
+            JOIN Countries AS C ON C.Country_ID = S.Country_ID
+            WHERE SSR.Score IS NOT NULL
+            GROUP BY C.Name, SSR.Code
+        """)):
+            mean = total / students
+            scores.append((country, code, students, mean, math.sqrt(max(0.0, squares / students - mean * mean)), low, high))
+        students_per_country = {country: students for country, code, students, *_ in scores if code == AGGREGATES_BENCHMARK_CODE}
+
+        benchmarks = []
+        for country, benchmark, threshold, students in connection.execute(text("""
+            SELECT C.Name, B.Name, B.Score, COUNT(SSR.Student_ID)
+            FROM Benchmarks AS B
+            JOIN StudentScoreResults AS SSR ON SSR.Score >= B.Score
+            JOIN Students AS S ON S.Student_ID = SSR.Student_ID
+            JOIN Countries AS C ON C.Country_ID = S.Country_ID
+            WHERE SSR.Code = :code
+            GROUP BY C.Name, B.Name, B.Score
+        """), {'code': AGGREGATES_BENCHMARK_CODE}):
+            benchmarks.append((country, benchmark, threshold, students, students / students_per_country[country]))
+
+        answers = []
+        for questionnaire, (answers_table, joins) in ANSWER_COUNTRIES.items():
+            rows = connection.execute(text(f"""
+                SELECT C.Name, A.Code, A.Answer, COUNT(*)
+                FROM {answers_table} AS A
+                {joins}
+                JOIN Countries AS C ON C.Country_ID = E.Country_ID
+                GROUP BY C.Name, A.Code, A.Answer
+            """)).all()
+            respondents: dict[tuple[str, str], int] = {}
+            for country, code, _, count in rows:
+                respondents[country, code] = respondents.get((country, code), 0) + count
+            answers.extend(
+                (questionnaire, country, code, answer, count, count / respondents[country, code])
+                for country, code, answer, count in rows
+            )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.unlink(missing_ok=True)
+    aggregates = sqlite3.connect(tmp_path)
+    try:
+        aggregates.executescript(SCHEMA)
+        aggregates.executemany('INSERT INTO CountryScores VALUES (?, ?, ?, ?, ?, ?, ?)', scores)
+        aggregates.executemany('INSERT INTO BenchmarkAttainment VALUES (?, ?, ?, ?, ?)', benchmarks)
+        aggregates.executemany('INSERT INTO AnswerDistribution VALUES (?, ?, ?, ?, ?, ?)', answers)
+        aggregates.execute("INSERT INTO Metadata VALUES ('built_at', ?)", (str(time.time()),))
+        aggregates.commit()
+    finally:
+        aggregates.close()
+    tmp_path.replace(path)
+    return {'CountryScores': len(scores), 'BenchmarkAttainment': len(benchmarks), 'AnswerDistribution': len(answers)}
+
+
+def is_available(path: Path = AGGREGATES_PATH) -> bool:
+    # the file is written in one go and moved into place, its modification time is the build time
+    try:
+        return time.time() - path.stat().st_mtime <= AGGREGATES_MAX_AGE
+    except FileNotFoundError:
+        return False
+
+
+# Actions of the agents' SQL the authorizer allows: reading tables and calling functions in a (recursive) SELECT
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+def _authorize(action: int, *_: object) -> int:
+    return sqlite3.SQLITE_OK if action in _ALLOWED_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def _connect(path: Path = AGGREGATES_PATH) -> sqlite3.Connection:
+    # read-only, the agents' SQL cannot change the aggregates. `mode=ro` only covers this database, the authorizer
+    # also denies ATTACH (which could create or write other files), pragmas and every other statement than a SELECT
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+    connection.set_authorizer(_authorize)
+    return connection
+
+
+def refresh_in_background() -> None:
+    """Rebuilds the aggregates in a background thread, unless a rebuild is already running or one was attempted less
+    than `AGGREGATES_REFRESH_INTERVAL` seconds ago."""
+    global _LAST_REFRESH
+    if time.time() - _LAST_REFRESH < AGGREGATES_REFRESH_INTERVAL or not _BUILD_LOCK.acquire(blocking=False):
+        return
+    _LAST_REFRESH = time.time()
+
+    def refresh():
+        try:
+            build_aggregates()
+        except Exception as e:
+            logging.warning(f'Building the aggregates failed, agents will query the database: {e}')
+        finally:
+            _BUILD_LOCK.release()
+
+    threading.Thread(target=refresh, name='aggregates', daemon=True).start()
+
+
+def warm_up() -> None:
+    if not is_available() and AGGREGATES_AUTO_BUILD:
+        refresh_in_background()
+
+
+@tool
+def query_aggregates(query: str) -> str:
+    """Query small pre-computed aggregate tables of the PIRLS data (SQLite SQL). Prefer it over `query_database`
+    for per-country score statistics, benchmark attainment and answer distributions, it answers in milliseconds.
+
+    Tables:
+        CountryScores(Country, Code, Students, Mean, StdDev, Min, Max): statistics of StudentScoreResults per country
+            (Countries.Name) and score code, e.g. Code = 'ASRREA_avg' for the overall reading score.
+        BenchmarkAttainment(Country, Benchmark, Threshold, Students, Share): students per country whose overall reading
+            score (ASRREA_avg) is at or above each international benchmark, and their share of the country's students.
+        AnswerDistribution(Questionnaire, Country, Code, Answer, Respondents, Share): answers per country to every
+            question code of the 'Students', 'Homes', 'Schools', 'Teachers' and 'Curricula' questionnaires, with their
+            share of the respondents of that question in that country.
+
+    Args:
+        query (str): The SQLite query to execute.
+
+    Returns:
+        str: The results of the query as CSV with a header line.
+    """
+    check_cancelled()
+    with span('tool.query_aggregates', 'tool', **{'db.statement': query}) as current:
+        if not is_available():
+            warm_up()
+            return 'The aggregates are not available, use the query_database tool instead.'
+        try:
+            with contextlib.closing(_connect()) as connection:
+                cursor = connection.execute(query)
+                rows = cursor.fetchmany(AGGREGATES_MAX_ROWS + 1)
+                columns = [column[0] for column in cursor.description or []]
+        except Exception as e:
+            return f'Wrong query, encountered exception {e}.'
+
+        current.set(**{'db.rows': len(rows)})
+        return with_query(
+            query, get_formatter().format(columns, rows[:AGGREGATES_MAX_ROWS], len(rows) <= AGGREGATES_MAX_ROWS)
+        )
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    start = time.time()
+    counts = build_aggregates()
+    logging.info(f'Aggregates {counts} written to {AGGREGATES_PATH} in {time.time() - start:.1f}s')
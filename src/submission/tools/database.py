@@ -1,7 +1,73 @@
+import contextlib
+import os
+
 from langchain_core.tools import tool
 from sqlalchemy import text
-from src.static.util import ENGINE
-from typing import Literal
+from src.static.call_context import cancellable, check_cancelled
+from src.static.metrics import DB_QUERIES_IN_FLIGHT, DB_QUERY_LATENCY
+from src.static.util import get_engine
+from src.static.query_cache import QUERY_CACHE, normalize_sql
+from src.static.sql_guard import QueryRejected, guard_query
+from src.static.tracing import Span, span
+from src.submission.tools import questionnaire_index
+from src.submission.tools.formatting import ResultFormatter, fit_lines, get_formatter, with_query
+from typing import Iterator, Literal, Optional
+
+# Agent queries are streamed through a server-side cursor in batches of `QUERY_FETCH_SIZE` rows. At most
+# `QUERY_MAX_ROWS` rows are read per query, they are what the footer and summary of a truncated result are about.
+# Long-running statements are cut off by `DB_STATEMENT_TIMEOUT_MS` (see src/static/util.py), and queries the planner
+# estimates too expensive are not run at all (see src/static/sql_guard.py).
+QUERY_MAX_ROWS = int(os.environ.get('QUERY_MAX_ROWS', 1_000))
+QUERY_FETCH_SIZE = int(os.environ.get('QUERY_FETCH_SIZE', 500))
+
+
+@contextlib.contextmanager
+def _executing(query: str) -> Iterator[Span]:
+    """Traces and times the execution of `query`, including reading its rows."""
+    with span('sql.execute', 'db', **{'db.statement': query}) as current, DB_QUERIES_IN_FLIGHT.track(), \
+            DB_QUERY_LATENCY.time():
+        yield current
+
+
+def _fetch_rows(query: str) -> list[tuple]:
+    """Executes `query` and returns all rows, serving repeated (normalized) queries from `QUERY_CACHE`."""
+    def execute() -> list[tuple]:
+        with _executing(query) as current, get_engine().connect() as connection, \
+                cancellable(connection.connection.dbapi_connection):
+            rows = [tuple(row) for row in connection.execute(text(query))]
+            current.set(**{'db.rows': len(rows)})
+            return rows
+
+    return QUERY_CACHE.get_or_compute(('rows', normalize_sql(query)), execute)
+
+
+def _stream_result(query: str, formatter: Optional[ResultFormatter] = None) -> str:
+    """Executes `query` and renders its rows with `formatter` (default: `get_formatter()`).
+
+    Rows are fetched in batches of `QUERY_FETCH_SIZE` from a server-side cursor, and reading stops after
+    `QUERY_MAX_ROWS` rows: the cursor is closed and the database stops producing rows. The formatter shows the rows
+    that fit into its token budget and summarizes the rest. The statement of a cancelled call is cancelled on the
+    server. On Postgres the query first goes through `guard_query`, which may add a `LIMIT` or raise `QueryRejected`.
+    """
+    rows = []
+    exhausted = True
+    with _executing(query) as current, get_engine().connect() as connection, \
+            cancellable(connection.connection.dbapi_connection):
+        res = connection.execution_options(yield_per=QUERY_FETCH_SIZE).execute(
+            text(guard_query(connection, query, QUERY_MAX_ROWS, current))
+        )
+        columns = list(res.keys())
+        for result in res:
+            if len(rows) % QUERY_FETCH_SIZE == 0:
+                check_cancelled()
+            if len(rows) == QUERY_MAX_ROWS:
+                exhausted = False
+                break
+            rows.append(tuple(result))
+        res.close()
+        current.set(**{'db.rows': len(rows), 'db.rows_exhausted': exhausted})
+
+    return (formatter or get_formatter()).format(columns, rows, exhausted)
 
 
 @tool
@@ -12,23 +78,27 @@ def query_database(query: str) -> str:
         query (str): The SQL query to execute.
 
     Returns:
-        str: The results of the query as a string, where each row is separated by a newline.
+        str: The results of the query as CSV with a header line. Columns with the same value in every row are listed
+            once above the rows, and long results are truncated with a summary of their numeric columns.
 
     Raises:
         Exception: If the query is invalid or encounters an exception during execution.
     """
-    with ENGINE.connect() as connection:
+    # only the truncated output is cached, so huge result sets do not stay in memory
+    check_cancelled()
+    with span('tool.query_database', 'tool', **{'db.statement': query}) as current:
         try:
-            res = connection.execute(text(query))
+            ret = QUERY_CACHE.get_or_compute(('query_database', normalize_sql(query)), lambda: _stream_result(query))
+        except QueryRejected as e:
+            current.set(**{'tool.error': str(e)})
+            return with_query(query, f'Rejected: {e}')
         except Exception as e:
+            current.set(**{'tool.error': str(e)})
             return f'Wrong query, encountered exception {e}.'
 
-    max_result_len = 3_000
-    ret = '\n'.join(", ".join(map(str, result)) for result in res)
-    if len(ret) > max_result_len:
-        ret = ret[:max_result_len] + '...\n(results too long. Output truncated.)'
-
-    return f'Query: {query}\nResult: {ret}'
+        ret = with_query(query, ret)
+        current.set(**{'tool.bytes': len(ret.encode())})
+        return ret
 
 
 @tool
@@ -49,26 +119,31 @@ def get_possible_answers_to_question(
     Returns:
         str: The list of all possible answers to the question with the code given in `question_code`.
     """
-    entity_id = 'curriculum_id' if general_table.lower() == 'curricula' else f'{general_table.lower()[:-1]}_id'
-    query = f"""
-        SELECT DISTINCT ATab.Answer
-        FROM {general_table} AS GTab
-        JOIN {questionnaire_answers_table} AS ATab ON ATab.{entity_id} = GTab.{entity_id}
-        JOIN {questionnaire_entries_table} AS ETab ON ETab.Code = ATab.Code
-        WHERE ATab.Code = '{question_code.replace("'", "").replace('"', '')}'
-    """
+    check_cancelled()
+    with span('tool.get_possible_answers_to_question', 'tool', **{'tool.question_code': question_code}) as current:
+        question_code = question_code.replace("'", "").replace('"', '')
+        answers = questionnaire_index.lookup_possible_answers(
+            general_table, questionnaire_answers_table, questionnaire_entries_table, question_code
+        )
+        current.set(**{'tool.source': 'sql' if answers is None else 'index'})
+        if answers is not None:
+            return fit_lines([str(answer) for answer in answers])
+
+        entity_id = 'curriculum_id' if general_table.lower() == 'curricula' else f'{general_table.lower()[:-1]}_id'
+        query = f"""
+            SELECT DISTINCT ATab.Answer
+            FROM {general_table} AS GTab
+            JOIN {questionnaire_answers_table} AS ATab ON ATab.{entity_id} = GTab.{entity_id}
+            JOIN {questionnaire_entries_table} AS ETab ON ETab.Code = ATab.Code
+            WHERE ATab.Code = '{question_code}'
+        """
 
-    with ENGINE.connect() as connection:
         try:
-            res = connection.execute(text(query))
+            res = _fetch_rows(query)
         except Exception as e:
             return f'Wrong query, encountered exception {e}.'
 
-    ret = ""
-    for result in res:
-        ret += ", ".join(map(str, result)) + "\n"
-
-    return ret
+        return fit_lines([", ".join(map(str, result)) for result in res])
 
 
 @tool
@@ -89,22 +164,28 @@ def get_questions_of_given_type(
         Returns:
             str: The list of all questions of type specified by `question_type`
         """
-    entity_id = 'curriculum_id' if general_table.lower() == 'curricula' else f'{general_table.lower()[:-1]}_id'
-    query = f"""
-        SELECT DISTINCT ETab.Question, ETab.Code
-        FROM {general_table} AS GTab
-        JOIN {questionnaire_answers_table} AS ATab ON ATab.{entity_id} = GTab.{entity_id}
-        JOIN {questionnaire_entries_table} AS ETab ON ETab.Code = ATab.Code
-        WHERE ETab.Type = '{question_type.replace("'", "").replace('"', '')}'
-    """
+    check_cancelled()
+    with span('tool.get_questions_of_given_type', 'tool', **{'tool.question_type': question_type}) as current:
+        question_type = question_type.replace("'", "").replace('"', '')
+        questions = questionnaire_index.lookup_questions(
+            general_table, questionnaire_answers_table, questionnaire_entries_table, question_type
+        )
+        current.set(**{'tool.source': 'sql' if questions is None else 'index'})
+        if questions is not None:
+            return fit_lines([f'(Code: {code}) {question}' for code, question in questions])
+
+        entity_id = 'curriculum_id' if general_table.lower() == 'curricula' else f'{general_table.lower()[:-1]}_id'
+        query = f"""
+            SELECT DISTINCT ETab.Question, ETab.Code
+            FROM {general_table} AS GTab
+            JOIN {questionnaire_answers_table} AS ATab ON ATab.{entity_id} = GTab.{entity_id}
+            JOIN {questionnaire_entries_table} AS ETab ON ETab.Code = ATab.Code
+            WHERE ETab.Type = '{question_type}'
+        """
 
-    with ENGINE.connect() as connection:
         try:
-            res = connection.execute(text(query))
+            res = _fetch_rows(query)
         except Exception as e:
             return f'Wrong query, encountered exception {e}.'
 
-    questions = []
-    for question, code in res:
-        questions.append(f'(Code: {code}) {question}\n')
-    return ''.join(questions)
+        return fit_lines([f'(Code: {code}) {question}' for question, code in res])
@@ -0,0 +1,185 @@
+"""Rendering of tool results for the agents' context.
+
+Every tool output becomes part of the prompt of all following agent steps, so results are rendered compactly: a
+header line once, CSV (or TSV) rows, floats rounded to `RESULT_SIGNIFICANT_DIGITS` significant digits, and columns
+with the same value in every row stated once above the rows. Rows are added while they fit into `RESULT_MAX_TOKENS`
+tokens of the model's tokenizer. When rows are left out, the numeric columns are summarized over all rows read.
+
+Formatters are looked up by name in `FORMATTERS` (`RESULT_FORMAT` selects the default), another format is a subclass
+of `ResultFormatter` registered there.
+"""
+import csv
+import io
+import logging
+import math
+import os
+from abc import ABC, abstractmethod
+from decimal import Decimal
+from typing import Any, Callable, Optional, Sequence
+
+import dotenv
+
+dotenv.load_dotenv()
+
+RESULT_FORMAT = os.environ.get('RESULT_FORMAT', 'csv')
+RESULT_MAX_TOKENS = int(os.environ.get('RESULT_MAX_TOKENS', 1_000))
+RESULT_SIGNIFICANT_DIGITS = int(os.environ.get('RESULT_SIGNIFICANT_DIGITS', 6))
+# The agent wrote the query a step earlier, repeating it in the result only costs tokens
+RESULT_ECHO_QUERY = os.environ.get('RESULT_ECHO_QUERY', 'false').lower() in ('1', 'true', 'yes')
+
+_COUNT_TOKENS: Optional[Callable[[str], int]] = None
+
+
+def _load_token_counter() -> Callable[[str], int]:
+    # the Claude tokenizer ChatBedrock counts tokens with, then tiktoken, then about four characters per token
+    try:
+        import anthropic
+        tokenizer = anthropic.Anthropic(api_key='unused').get_tokenizer()
+        return lambda text: len(tokenizer.encode(text).ids)
+    except Exception as e:
+        logging.debug(f'No anthropic tokenizer ({e}), trying tiktoken')
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logging.debug(f'No tiktoken encoding ({e}), estimating tokens from the length')
+    return lambda text: (len(text) + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    global _COUNT_TOKENS
+    if _COUNT_TOKENS is None:
+        _COUNT_TOKENS = _load_token_counter()
+    return _COUNT_TOKENS(text) if text else 0
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def format_value(value: Any, significant_digits: int = RESULT_SIGNIFICANT_DIGITS) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (float, Decimal)) and not isinstance(value, bool):
+        value = float(value)
+        if not math.isfinite(value) or value == 0:
+            return str(value)
+        # never drop digits before the decimal point, `.6g` would write 1234567.8 as 1.23457e+06
+        digits = max(significant_digits, int(math.floor(math.log10(abs(value)))) + 1)
+        return f'{value:.{digits}g}'
+    return str(value)
+
+
+def fit_lines(lines: Sequence[str], max_tokens: int = RESULT_MAX_TOKENS) -> str:
+    """Joins the lines while they fit into `max_tokens`, with a note on how many were left out."""
+    shown = []
+    tokens = 0
+    for line in lines:
+        tokens += count_tokens(line) + 1
+        if tokens > max_tokens and shown:
+            return '\n'.join(shown) + f'\n...\n(results too long. Output truncated, {len(lines) - len(shown)} more ' \
+                                      f'lines omitted.)'
+        shown.append(line)
+    return '\n'.join(shown)
+
+
+class ResultFormatter(ABC):
+    """Renders the rows of a query: header, rows within the token budget and the notes on what was left out."""
+
+    def __init__(self, max_tokens: int = RESULT_MAX_TOKENS, significant_digits: int = RESULT_SIGNIFICANT_DIGITS):
+        self.max_tokens = max_tokens
+        self.significant_digits = significant_digits
+
+    @abstractmethod
+    def format_row(self, values: Sequence[str]) -> str:
+        ...
+
+    def format(self, columns: Sequence[str], rows: Sequence[Sequence[Any]], exhausted: bool = True) -> str:
+        """`rows` are all rows read, `exhausted` is False if the query has more rows that were not read."""
+        values = [[format_value(value, self.significant_digits) for value in row] for row in rows]
+        columns = list(columns) or [f'column{index + 1}' for index in range(len(values[0]) if values else 0)]
+        lines = []
+
+        # columns with a single value are stated once, unless that would leave no column
+        shown = list(range(len(columns)))
+        if len(values) > 1:
+            constant = [index for index in shown if all(row[index] == values[0][index] for row in values)]
+            if constant and len(constant) < len(columns):
+                lines.append('Same in every row: ' + ', '.join(f'{columns[i]} = {values[0][i]}' for i in constant))
+                shown = [index for index in shown if index not in constant]
+
+        lines.append(self.format_row([columns[index] for index in shown]))
+        tokens = sum(count_tokens(line) + 1 for line in lines)
+        rendered = 0
+        for row in values:
+            line = self.format_row([row[index] for index in shown])
+            tokens += count_tokens(line) + 1
+            if tokens > self.max_tokens:
+                if rendered:
+                    break
+                # a single row longer than the budget is still shown, cut to about the budget
+                line = line[:self.max_tokens * 4] + '...'
+            lines.append(line)
+            rendered += 1
+        if not values:
+            lines.append('(no rows)')
+
+        # a query that was not read to the end has at least one more row
+        omitted = len(values) - rendered + (0 if exhausted else 1)
+        if omitted:
+            lines.append('...')
+            lines.append(
+                f'(results too long. Output truncated, {"at least " if not exhausted else ""}{omitted} more rows '
+                f'omitted.)'
+            )
+            summary = self.summarize(columns, rows)
+            if summary:
+                lines.append(f'Summary of the {"first " if not exhausted else ""}{len(rows)} rows: {summary}')
+        return '\n'.join(lines)
+
+    def summarize(self, columns: Sequence[str], rows: Sequence[Sequence[Any]]) -> str:
+        """Min, max and mean of the numeric columns."""
+        parts = []
+        for index, column in enumerate(columns):
+            numbers = [row[index] for row in rows if row[index] is not None]
+            if not numbers or not all(_is_number(number) for number in numbers):
+                continue
+            numbers = [float(number) for number in numbers]
+            low, high, mean = (format_value(value, self.significant_digits)
+                               for value in (min(numbers), max(numbers), sum(numbers) / len(numbers)))
+            parts.append(f'{column} min {low}, max {high}, mean {mean}')
+        return '; '.join(parts)
+
+
+class DelimitedFormatter(ResultFormatter):
+    delimiter = ','
+
+    def format_row(self, values: Sequence[str]) -> str:
+        # quoted only where a value contains the delimiter, a quote or a line break
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter=self.delimiter, lineterminator='').writerow(values)
+        return buffer.getvalue()
+
+
+class CsvFormatter(DelimitedFormatter):
+    delimiter = ','
+
+
+class TsvFormatter(DelimitedFormatter):
+    delimiter = '\t'
+
+
+FORMATTERS: dict[str, type[ResultFormatter]] = {
+    'csv': CsvFormatter,
+    'tsv': TsvFormatter,
+}
+
+
+def get_formatter(name: Optional[str] = None, **kwargs: Any) -> ResultFormatter:
+    return FORMATTERS[name or RESULT_FORMAT](**kwargs)
+
+
+def with_query(query: str, result: str) -> str:
+    """The tool output for `result` of `query`, repeating the query only with `RESULT_ECHO_QUERY`."""
+    return f'Query: {query}\nResult: {result}' if RESULT_ECHO_QUERY else result
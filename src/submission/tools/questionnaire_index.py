@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import dotenv
+from sqlalchemy import text
+
+from src.static.util import PROJECT_ROOT, get_engine
+
+dotenv.load_dotenv()
+
+# general table -> (questionnaire answers table, questionnaire entries table, entity id column)
+QUESTIONNAIRE_FAMILIES: dict[str, tuple[str, str, str]] = {
+    'Students': ('StudentQuestionnaireAnswers', 'StudentQuestionnaireEntries', 'student_id'),
+    'Curricula': ('CurriculumQuestionnaireAnswers', 'CurriculumQuestionnaireEntries', 'curriculum_id'),
+    'Homes': ('HomeQuestionnaireAnswers', 'HomeQuestionnaireEntries', 'home_id'),
+    'Teachers': ('TeacherQuestionnaireAnswers', 'TeacherQuestionnaireEntries', 'teacher_id'),
+    'Schools': ('SchoolQuestionnaireAnswers', 'SchoolQuestionnaireEntries', 'school_id'),
+}
+
+INDEX_PATH = Path(os.environ.get('QUESTIONNAIRE_INDEX_PATH', PROJECT_ROOT.parent / '.cache' / 'questionnaire_index.json'))
+INDEX_MAX_AGE = float(os.environ.get('QUESTIONNAIRE_INDEX_MAX_AGE', 7 * 24 * 3600))
+# Building the index runs `SELECT DISTINCT` over every *QuestionnaireAnswers table (tens of millions of rows), so by
+# default a service process only loads the file written by `python -m src.submission.tools.questionnaire_index`.
+# With auto build enabled every replica builds the index itself on startup and whenever it becomes stale.
+INDEX_AUTO_BUILD = os.environ.get('QUESTIONNAIRE_INDEX_AUTO_BUILD', 'false').lower() in ('1', 'true', 'yes')
+# Minimum number of seconds between two background refresh attempts
+INDEX_REFRESH_INTERVAL = float(os.environ.get('QUESTIONNAIRE_INDEX_REFRESH_INTERVAL', 60))
+
+
+class QuestionnaireIndex:
+    """In-memory questionnaire metadata: question type -> [(code, question)] and question code -> distinct answers,
+    per questionnaire family (general table)."""
+
+    def __init__(
+            self,
+            questions: dict[str, dict[str, list[tuple[str, str]]]],
+            answers: dict[str, dict[str, list[str]]],
+            built_at: float
+    ):
+        self.questions = questions
+        self.answers = answers
+        self.built_at = built_at
+
+    def is_stale(self, max_age: float = INDEX_MAX_AGE) -> bool:
+        return time.time() - self.built_at > max_age
+
+    def to_json(self) -> dict:
+        return {'questions': self.questions, 'answers': self.answers, 'built_at': self.built_at}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'QuestionnaireIndex':
+        questions = {
+            family: {q_type: [tuple(entry) for entry in entries] for q_type, entries in types.items()}
+            for family, types in data['questions'].items()
+        }
+        return cls(questions, data['answers'], data['built_at'])
+
+
+_INDEX: Optional[QuestionnaireIndex] = None
+_BUILD_LOCK = threading.Lock()
+_LAST_REFRESH = 0.0
+
+
+def build_index() -> QuestionnaireIndex:
+    questions, answers = {}, {}
+    with get_engine().connect() as connection:
+        for general_table, (answers_table, entries_table, entity_id) in QUESTIONNAIRE_FAMILIES.items():
+            # same joins as the tools use, so the index lists exactly what the SQL would return
+            joins = f"""
+                FROM {general_table} AS GTab
+                JOIN {answers_table} AS ATab ON ATab.{entity_id} = GTab.{entity_id}
+                JOIN {entries_table} AS ETab ON ETab.Code = ATab.Code
+            """
+            family_questions = questions[general_table] = {}
+            for q_type, question, code in connection.execute(text(f'SELECT DISTINCT ETab.Type, ETab.Question, ETab.Code {joins}')):
+                family_questions.setdefault(q_type, []).append((code, question))
+            family_answers = answers[general_table] = {}
+            for code, answer in connection.execute(text(f'SELECT DISTINCT ATab.Code, ATab.Answer {joins}')):
+                family_answers.setdefault(code, []).append(answer)
+    return QuestionnaireIndex(questions, answers, time.time())
+
+
+def save_index(index: QuestionnaireIndex, path: Path = INDEX_PATH) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(index.to_json()))
+    tmp_path.replace(path)
+
+
+def load_index(path: Path = INDEX_PATH) -> Optional[QuestionnaireIndex]:
+    if not path.exists():
+        return None
+    try:
+        return QuestionnaireIndex.from_json(json.loads(path.read_text()))
+    except Exception as e:
+        logging.warning(f'Could not load questionnaire index from {path}: {e}')
+        return None
+
+
+def rebuild_index(persist: bool = True) -> QuestionnaireIndex:
+    global _INDEX
+    with _BUILD_LOCK:
+        index = build_index()
+        if persist:
+            save_index(index)
+        _INDEX = index
+    return index
+
+
+def _refresh() -> None:
+    global _INDEX
+    if INDEX_AUTO_BUILD:
+        index = build_index()
+        save_index(index)
+        _INDEX = index
+        return
+    index = load_index()
+    if index is not None and (_INDEX is None or index.built_at > _INDEX.built_at):
+        _INDEX = index
+
+
+def _refresh_in_background() -> None:
+    """Builds (or reloads from disk) the index in a background thread, unless a refresh is already running or one was
+    attempted less than `INDEX_REFRESH_INTERVAL` seconds ago."""
+    global _LAST_REFRESH
+    if time.time() - _LAST_REFRESH < INDEX_REFRESH_INTERVAL or not _BUILD_LOCK.acquire(blocking=False):
+        return
+    _LAST_REFRESH = time.time()
+
+    def refresh():
+        try:
+            _refresh()
+        except Exception as e:
+            logging.warning(f'Refreshing the questionnaire index failed, tools will keep using SQL: {e}')
+        finally:
+            _BUILD_LOCK.release()
+
+    threading.Thread(target=refresh, name='questionnaire-index', daemon=True).start()
+
+
+def warm_up() -> None:
+    """Loads a fresh index from disk, or refreshes it in a background thread. Until then the tools fall back to SQL."""
+    global _INDEX
+    index = load_index()
+    if index is not None and not index.is_stale():
+        _INDEX = index
+        return
+    _refresh_in_background()
+
+
+def get_index() -> Optional[QuestionnaireIndex]:
+    """Returns the current index, or None if it was not built yet or is stale. A missing or stale index triggers a
+    background refresh, so the tools use SQL only until it is done."""
+    index = _INDEX
+    if index is None or index.is_stale():
+        _refresh_in_background()
+        return None
+    return index
+
+
+def lookup_possible_answers(general_table: str, answers_table: str, entries_table: str, question_code: str) -> Optional[list[str]]:
+    index = get_index()
+    if index is None or QUESTIONNAIRE_FAMILIES.get(general_table, ())[:2] != (answers_table, entries_table):
+        return None
+    return index.answers[general_table].get(question_code, [])
+
+
+def lookup_questions(general_table: str, answers_table: str, entries_table: str, question_type: str) -> Optional[list[tuple[str, str]]]:
+    index = get_index()
+    if index is None or QUESTIONNAIRE_FAMILIES.get(general_table, ())[:2] != (answers_table, entries_table):
+        return None
+    return index.questions[general_table].get(question_type, [])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    start = time.time()
+    rebuilt = rebuild_index()
+    logging.info(
+        f'Questionnaire index with {sum(map(len, rebuilt.answers.values()))} question codes '
+        f'written to {INDEX_PATH} in {time.time() - start:.1f}s'
+    )
@@ -0,0 +1,20 @@
+from src.submission.tools import database, questionnaire_index
+from src.submission.tools.formatting import CsvFormatter, fit_lines
+
+
+def test_fit_lines_truncates_to_budget():
+    result = fit_lines(['x' * 40] * 10, max_tokens=30)
+    assert result.endswith('(results too long. Output truncated, 8 more lines omitted.)')
+
+
+def test_possible_answers_from_index_with_non_string_answers(monkeypatch):
+    monkeypatch.setattr(questionnaire_index, 'lookup_possible_answers', lambda *args: ['Yes', 1, None, 2.5])
+    result = database.get_possible_answers_to_question.func(
+        'Students', 'StudentQuestionnaireAnswers', 'StudentQuestionnaireEntries', 'ASBG01'
+    )
+    assert result.split('\n') == ['Yes', '1', 'None', '2.5']
+
+
+def test_csv_formatter_hoists_constant_columns():
+    result = CsvFormatter().format(['Country', 'Score'], [('Norway', 1.23456789), ('Norway', 2)])
+    assert result.split('\n') == ['Same in every row: Country = Norway', 'Score', '1.23457', '2']
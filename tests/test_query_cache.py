@@ -0,0 +1,50 @@
+from src.static.query_cache import QueryCache, normalize_sql
+
+
+def test_normalize_sql_ignores_formatting():
+    assert normalize_sql("SELECT  DISTINCT Name -- comment\nFROM Countries WHERE x = 01.50;") == \
+        normalize_sql("select distinct name from countries where X = 1.5")
+
+
+def test_normalize_sql_keeps_quoted_text():
+    assert normalize_sql("SELECT * FROM t WHERE a = 'Yes'") != normalize_sql("SELECT * FROM t WHERE a = 'yes'")
+    assert normalize_sql('SELECT "Name" FROM t') != normalize_sql('SELECT "name" FROM t')
+
+
+def test_normalize_sql_keeps_dollar_quoted_text():
+    assert normalize_sql("SELECT * FROM t WHERE a = $$Yes$$") != normalize_sql("SELECT * FROM t WHERE a = $$yes$$")
+    assert normalize_sql("SELECT $tag$It's A$tag$") == "select $tag$It's A$tag$"
+
+
+def test_normalize_sql_numbers():
+    assert normalize_sql('SELECT 1e5') != normalize_sql('SELECT 1 e5')
+    assert normalize_sql('SELECT 1E+05') == 'select 1e+05'
+    assert normalize_sql('SELECT 5 / 2.0') != normalize_sql('SELECT 5 / 2')
+
+
+def test_query_cache_lru_eviction():
+    cache = QueryCache(max_size=2, ttl=None)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_query_cache_zero_ttl_disables_caching():
+    cache = QueryCache(max_size=10, ttl=0)
+    calls = []
+    cache.get_or_compute('a', lambda: calls.append(1))
+    cache.get_or_compute('a', lambda: calls.append(1))
+    assert len(calls) == 2
+    assert cache.stats()['size'] == 0
+
+
+def test_query_cache_invalidate():
+    cache = QueryCache(max_size=10, ttl=None)
+    cache.put(('rows', 'x'), 1)
+    cache.put(('query_database', 'y'), 2)
+    assert cache.invalidate(lambda key: key[0] == 'rows') == 1
+    assert cache.invalidate() == 1
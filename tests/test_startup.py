@@ -0,0 +1,12 @@
+import os
+
+from src.static.startup_profile import profile_startup
+
+# Seconds a fresh replica may spend importing the service, generous enough for slow CI machines
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', 2.0))
+
+
+def test_app_import_defers_heavy_modules():
+    profile = profile_startup('src.static.app')
+    assert profile.loaded_deferred == []
+    assert profile.wall_time < STARTUP_BUDGET
@@ -0,0 +1,19 @@
+from src.static.ChatBedrockWrapper import TOKEN_COUNT_CACHE, ChatBedrockWrapper
+
+
+def test_count_tokens_batch_tokenizes_each_distinct_text_once(monkeypatch):
+    tokenized = []
+
+    def get_num_tokens(self, text):
+        tokenized.append(text)
+        return len(text.split())
+
+    monkeypatch.setattr(ChatBedrockWrapper, 'get_num_tokens', get_num_tokens)
+    TOKEN_COUNT_CACHE.invalidate()
+    llm = ChatBedrockWrapper(call_id='test', model_id='test-model', client=object(), region_name='us-east-1')
+
+    assert llm.count_tokens('cached text') == 2
+    assert llm.count_tokens_batch(['a b c', 'cached text', '', 'a b c', 'd']) == [3, 2, 0, 3, 1]
+    assert tokenized == ['cached text', 'a b c', 'd']
+    assert llm.count_tokens_batch(['d', 'a b c']) == [1, 3]
+    assert len(tokenized) == 3